@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+"""
+Lines/s through a FilterAnalyzer with 10, 100 and 1000 Bond-style device filters.
+
+"indexed" is FilterAnalyzer as is. "linear" is the analyzer as it was before children were indexed - every
+line is matched against every child pattern.
+
+    python3 benchmarks/filter_analyzer.py
+"""
+
+import logging
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from shell_listener import FilterAnalyzer
+
+LINES = 3000
+
+
+class LinearFilterAnalyzer(FilterAnalyzer):
+    """FilterAnalyzer before the literal index: each child is a callback of its parent, called for every line."""
+
+    def __init__(self, parent_analyzer=None, pattern=None, log=True):
+        self.parent = parent_analyzer
+        self.pattern = re.compile(pattern) if pattern else None
+        self.callbacks = []
+        self.log = log
+        if self.parent:
+            self.parent.register(lambda line, matched_group: self._process_line(line))
+
+    def _process_line(self, line):
+        if self.pattern:
+            match = self.pattern.search(line)
+            if not match: return
+            matched_group = match.groupdict() if match.groupdict() else match.group(1) if match.groups() else line
+        else:
+            matched_group = line
+        analyzed = any([self.safe_callback(callback, line, matched_group) is not None for callback in self.callbacks])
+        return analyzed if self.log else None
+
+    def filter(self, pattern, log=True):
+        return LinearFilterAnalyzer(self, pattern, log)
+
+
+def rate(root: FilterAnalyzer, lines) -> float:
+    root._process_line(lines[0])  # Compile the dispatcher outside the measurement
+    start = time.perf_counter()
+    for line in lines:
+        root._process_line(line)
+    return len(lines) / (time.perf_counter() - start)
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    random.seed(1)
+    print(f"{'filters':>7}  {'indexed':>10}  {'linear':>10}")
+    for filters in (10, 100, 1000):
+        ids = [f"{random.getrandbits(32):08x}" for _ in range(filters)]
+        lines = [f'{{"B":"ZZ","t":"devices/{random.choice(ids)}/state","b":{{"power":1,"speed":3}}}}' for _ in range(LINES)]
+        rates = []
+        for root in (FilterAnalyzer(), LinearFilterAnalyzer()):
+            for device_id in ids:
+                root.filter(f'devices/{device_id}/state.*"power":(?:0|1.*"speed":(0|1|2|3|4|5|6))').register(lambda line, match: None)
+            rates.append(rate(root, lines))
+        print(f"{filters:>7}  {rates[0]:>8,.0f}/s  {rates[1]:>8,.0f}/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/python3
+"""
+Per-line cost of Lutron event dispatch as the number of registered handlers grows.
+
+Registers a mix of outputs, sysvars and keypad buttons on a Lutron service that is never connected,
+and feeds monitoring lines for them (plus lines nobody handles) through the dispatcher.
+
+    python3 benchmarks/lutron_dispatch.py
+"""
+
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.lutron import Lutron, LutronKeypad
+
+LINES = 200000
+
+
+def build(handlers: int) -> Lutron:
+    lutron = Lutron(host="127.0.0.1")
+    for i in range(handlers):
+        if i % 4 == 0:
+            lutron.sysvar(i)
+        elif i % 4 == 1:
+            LutronKeypad(lutron, i, 3)  # Lutron.keypad() is the unindexed #DEVICE toggle
+        else:
+            lutron.device(i)
+    return lutron
+
+
+def lines(handlers: int):
+    lines = []
+    for i in range(handlers):
+        if i % 4 == 0:
+            lines.append(f"~SYSVAR,{i},1,{i % 5}")
+        elif i % 4 == 1:
+            lines.append(f"~DEVICE,{i},3,3")
+        else:
+            lines += [f"~OUTPUT,{i},1,{level:.2f}" for level in (0, 50, 100)]
+    lines += [f"~OUTPUT,{handlers + i},1,0.00" for i in range(handlers // 4)]  # Unhandled ids
+    return (lines * (LINES // len(lines) + 1))[:LINES]
+
+
+def main():
+    logging.disable(logging.INFO)  # Dispatch logs at DEBUG/INFO - measure the dispatch, not the logging
+    print(f"{'handlers':>8}  {'us/line':>7}")
+    for handlers in (20, 200, 2000):
+        lutron = build(handlers)
+        feed = lines(handlers)
+        start = time.perf_counter()
+        for line in feed:
+            lutron._process_event(line)
+        elapsed = time.perf_counter() - start
+        print(f"{handlers:>8}  {elapsed / len(feed) * 1e6:>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
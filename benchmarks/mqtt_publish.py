@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+"""
+MQTTClient publish throughput and keepalive under inbound traffic, against an in-process broker stand-in.
+
+- throughput: publishes PUBLISHES QoS 0 messages and waits until the broker has received all of them
+- keepalive: keepalive=2 while the broker publishes every 0.3s - the client must still send PINGREQs
+  (every keepalive/2 seconds) and keep its single connection
+
+    python3 benchmarks/mqtt_publish.py
+"""
+
+import logging
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.mqtt_client import MQTTClient
+
+PUBLISHES = 20000
+
+
+class Broker:
+    """Just enough of an MQTT broker: CONNACK, PUBACK, SUBACK, PINGRESP, and counts of what the client sent."""
+
+    def __init__(self, publish_interval=None):
+        self.server = socket.create_server(("127.0.0.1", 0))
+        self.port = self.server.getsockname()[1]
+        self.publish_interval = publish_interval
+        self.connections = 0
+        self.publishes = 0
+        self.pings = []  # Seconds since the first connection
+        self.start = None
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            sock, _ = self.server.accept()
+            self.connections += 1
+            self.start = self.start or time.monotonic()
+            threading.Thread(target=self._serve, args=(sock,), daemon=True).start()
+
+    def _serve(self, sock):
+        buffer = bytearray()
+        try:
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    return
+                buffer += data
+                while (packet := self._parse(buffer)) is not None:
+                    self._handle(sock, *packet)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _parse(buffer):
+        length, multiplier, pos = 0, 1, 1
+        while True:
+            if pos >= len(buffer):
+                return None
+            byte = buffer[pos]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            pos += 1
+            if not byte & 0x80:
+                break
+        if len(buffer) < pos + length:
+            return None
+        header, body = buffer[0], bytes(buffer[pos:pos + length])
+        del buffer[:pos + length]
+        return header, body
+
+    def _handle(self, sock, header, body):
+        packet_type = header & 0xF0
+        if packet_type == 0x10:  # CONNECT
+            sock.sendall(b"\x20\x02\x00\x00")
+            if self.publish_interval:
+                threading.Thread(target=self._publish_loop, args=(sock,), daemon=True).start()
+        elif packet_type == 0x30:  # PUBLISH
+            self.publishes += 1
+            if header & 0x06:
+                topic_length = struct.unpack_from("!H", body)[0]
+                sock.sendall(b"\x40\x02" + body[2 + topic_length:4 + topic_length])
+        elif packet_type == 0x80:  # SUBSCRIBE
+            sock.sendall(b"\x90\x03" + body[:2] + b"\x00")
+        elif packet_type == 0xC0:  # PINGREQ
+            self.pings.append(round(time.monotonic() - self.start, 1))
+            sock.sendall(b"\xd0\x00")
+
+    def _publish_loop(self, sock):
+        topic = b"espresense/devices/phone/living_room"
+        body = struct.pack("!H", len(topic)) + topic + b'{"distance": 1.2}'
+        while True:
+            try:
+                sock.sendall(bytes([0x30, len(body)]) + body)
+            except OSError:
+                return
+            time.sleep(self.publish_interval)
+
+
+def wait_connected(client):
+    while not client.connected:
+        time.sleep(0.01)
+
+
+def throughput():
+    broker = Broker()
+    client = MQTTClient("127.0.0.1", broker.port, max_queued=PUBLISHES)
+    client.start()
+    wait_connected(client)
+    start = time.perf_counter()
+    for i in range(PUBLISHES):
+        client.publish(f"connector/light/{i % 50}/set", str(i % 100))
+    queued = time.perf_counter() - start
+    while broker.publishes < PUBLISHES and time.perf_counter() - start < 30:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    client.stop()
+    print(f"throughput: {broker.publishes}/{PUBLISHES} publishes received in {elapsed * 1000:.0f}ms "
+          f"({broker.publishes / elapsed:,.0f}/s), caller spent {queued * 1e6 / PUBLISHES:.1f}us per publish")
+
+
+def keepalive():
+    broker = Broker(publish_interval=0.3)
+    client = MQTTClient("127.0.0.1", broker.port, keepalive=2, on_message=lambda topic, payload: None)
+    client.start()
+    time.sleep(6)
+    client.stop()
+    print(f"keepalive: {client.received} messages received, PINGREQs at {broker.pings}s, "
+          f"{broker.connections} connection(s)")
+
+
+def main():
+    logging.disable(logging.WARNING)
+    throughput()
+    keepalive()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+"""
+Time to the player's first byte and peak Python memory when speaking a long announcement.
+
+The Text-to-Speech client is replaced by one that returns a 3 minute mono 44.1kHz LINEAR16 WAV, and the
+player by this script (run as a child, it reads its stdin and reports when the first byte arrived).
+
+- buffered: the audio is synthesized and converted in full, then handed to the player with communicate()
+  (the flow before streaming, with the in-process conversion instead of ffmpeg)
+- streamed: GoogleTTS.speak - the player starts first and the audio is written to it a chunk at a time
+
+Also checks the resampling of a 24kHz response against np.interp.
+
+    python3 benchmarks/tts_stream.py
+"""
+
+import os
+import sys
+import time
+
+
+def player(report: str):
+    """Stand-in for raop_play: read stdin to the end, then report when the first byte came and how many came."""
+    first, size = None, 0
+    while chunk := sys.stdin.buffer.read1(65536):
+        first = first or time.time()
+        size += len(chunk)
+    with open(report, "w") as f:
+        f.write(f"{first} {size}")
+
+
+if __name__ == "__main__" and "TTS_STREAM_REPORT" in os.environ:
+    player(os.environ["TTS_STREAM_REPORT"])  # Before the imports below - a real player starts in milliseconds
+    sys.exit()
+
+import io
+import logging
+import subprocess
+import tempfile
+import tracemalloc
+import wave
+from unittest import mock
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from services.google_tts import GoogleTTS, SAMPLE_RATE, to_playable_wav
+
+SECONDS = 180
+REPORT = os.path.join(tempfile.gettempdir(), f"tts_stream_{os.getpid()}.out")
+
+
+def sine_wav(rate: int, seconds: float) -> bytes:
+    t = np.arange(int(rate * seconds)) / rate
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes((np.sin(2 * np.pi * 440 * t) * 8000).astype("<i2").tobytes())
+    return buffer.getvalue()
+
+
+def measure(label: str, run):
+    tracemalloc.start()
+    start = time.time()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    with open(REPORT) as f:
+        first, size = f.read().split()
+    print(f"{label:>9}: first byte {(float(first) - start) * 1000:4.0f}ms, total {(time.time() - start) * 1000:4.0f}ms, "
+          f"{int(size) / 1e6:.1f}MB played, peak Python memory {peak / 1e6:.1f}MB")
+
+
+def check_resampling():
+    source = sine_wav(24000, 1.0)
+    with wave.open(io.BytesIO(b"".join(to_playable_wav(source)))) as w:
+        converted = np.frombuffer(w.readframes(w.getnframes()), "<i2").reshape(-1, 2)
+    samples = np.frombuffer(sine_wav(24000, 1.0)[44:], "<i2").astype(np.float64)
+    expected = np.interp(np.arange(len(converted)) * 24000 / SAMPLE_RATE, np.arange(len(samples)), samples)
+    error = np.abs(converted[:, 0] - expected).max()
+    print(f"resampling 24kHz -> {SAMPLE_RATE}Hz: max difference from np.interp {error:.2f} LSB, "
+          f"channels equal: {bool((converted[:, 0] == converted[:, 1]).all())}")
+
+
+def main():
+    logging.disable(logging.INFO)
+    response = mock.Mock(audio_content=sine_wav(SAMPLE_RATE, SECONDS))
+    with mock.patch("services.google_tts.texttospeech.TextToSpeechClient"):
+        # speak() runs "<play_command> <homepod_ip> -v <volume> -", i.e. this script as the player
+        tts = GoogleTTS(os.path.abspath(__file__), 50, play_command=sys.executable, cache_size_mb=0)
+    tts.client.synthesize_speech = lambda **kwargs: response
+    os.environ["TTS_STREAM_REPORT"] = REPORT
+
+    def buffered():
+        audio = tts.synthesize_speech("announcement")
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "-v", "50", "-"], stdin=subprocess.PIPE)
+        process.communicate(input=audio)
+
+    try:
+        measure("buffered", buffered)
+        measure("streamed", lambda: tts.speak("announcement"))
+    finally:
+        os.remove(REPORT)
+    check_resampling()
+
+
+if __name__ == "__main__":
+    main()
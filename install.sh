@@ -16,14 +16,13 @@ if [ "$EUID" -ne 0 ]; then
 fi
 
 echo "Installing system dependencies..."
-apt install mosquitto-clients
 #apt install -y netcat python3-venv python3-full
 
 echo "Creating system-wide virtual environment in /opt/connector..."
 python3 -m venv /opt/connector
 
 echo "Installing Python dependencies..."
-/opt/connector/bin/pip install pyyaml google-cloud-texttospeech pytimeparse
+/opt/connector/bin/pip install pyyaml requests numpy google-cloud-texttospeech pytimeparse
 
 echo "Making main.py executable..."
 chmod +x "$SCRIPT_DIR/main.py"
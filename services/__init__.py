@@ -6,5 +6,6 @@ from .bond import Bond
 from .nuki import Nuki
 from .google_tts import GoogleTTS
 from .http_service import HTTP
+from .webhook import Webhook
 
-__all__ = ['Service', 'Connector', 'Lutron', 'MQTT', 'Bond', 'Nuki', 'GoogleTTS', 'HTTP'] 
\ No newline at end of file
+__all__ = ['Service', 'Connector', 'Lutron', 'MQTT', 'Bond', 'Nuki', 'GoogleTTS', 'HTTP', 'Webhook'] 
\ No newline at end of file
@@ -2,11 +2,16 @@
 
 from .connector import Connector
 from .service import Service
+from .executor import CoalescingExecutor, json_request
 from logger import get_logger
-from shell_listener import ShellListener
-import subprocess
-import re
-from typing import Dict
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+import socket
+from concurrent.futures import ThreadPoolExecutor
+import json
+import time
+from typing import Any, Callable, Dict, List, Optional
 
 # Get logger for this module
 logger = get_logger(__name__)
@@ -18,41 +23,210 @@ class BondDevice(Connector):
         self.bond = bond
         self.device_id = device_id
         self.name = f"Bond<{device_id}>"
+        self.state: Dict[str, Any] = {}  # Last full state pushed by the bridge
         
-        # Register the listener for both state updates and action responses
-        self.listener = self.bond.listener.filter(f'devices/{device_id}/state.*"power":(?:0|1.*"speed":(0|1|2|3|4|5|6))')
-        self.listener.register(self._on_speed_update)
-        # self.bond.listener.filter(f'devices/{device_id}/actions/SetSpeed.*"argument":(0|1|2|3|4|5|6)').register(self._on_speed_update)
+        # Register for state updates pushed by the bridge
+        self.bond.register_device(self)
     
-    def _on_speed_update(self, line: str, match: str):
+    def _on_state(self, state: Dict[str, Any]):
+        """Handle a devices/<id>/state push"""
+        self.state = state
+        if "power" not in state:
+            return
+        speed = state.get("speed") if state["power"] else 0
+        if speed is None:
+            return
         # Convert from 0-6 range to 0-1 range
-        value = round(int(match) / 6.0 *100 )/100.0 if match is not None else 0
+        value = round(int(speed) / 6.0 *100 )/100.0
         self.set(value, act=False)
-        print(f"Speed updated to {value:.2f} (level {match}/6) for device {self.device_id}")
+        logger.debug(f"Speed updated to {value:.2f} (level {speed}/6) for device {self.device_id}")
     
     def _set_action(self, value: float) -> None:
         """Override _set_action to send Bond command when value changes"""
         if value == 1.0: # 1.0 (as opposed to 0.99) means someone just wanted to open the device on last level
-            cmd = f'sleep 0.1; curl -sS -H "BOND-Token: {self.bond.token}" http://{self.bond.address}/v2/devices/{self.device_id}/actions/TurnOn -X PUT -d "{{}}"'
+            self.bond.client.action(self.device_id, "TurnOn")
         elif value == 0:
-            cmd = f'sleep 0.1; curl -sS -H "BOND-Token: {self.bond.token}" http://{self.bond.address}/v2/devices/{self.device_id}/actions/TurnOff -X PUT -d "{{}}"'
+            self.bond.client.action(self.device_id, "TurnOff")
         else:
             # Convert from 0-1 range to 0-6 range, rounding to nearest integer
-            cmd = f'curl -sS -H "BOND-Token: {self.bond.token}" http://{self.bond.address}/v2/devices/{self.device_id}/actions/SetSpeed -X PUT -d "{{\\"argument\\": {round(value * 6)} }}"'
-        
-        logger.info("Running command: %s", self.bond.reduct(cmd))
-        result = subprocess.run(cmd, shell=True, check=True, capture_output=True, text=True)
+            self.bond.client.action(self.device_id, "SetSpeed", round(value * 6))
         # The actual speed update will come through the state update listener
 
+
+class BondClient:
+    """
+    HTTP client for the Bond local API.
+
+    Actions for one device run in order, and an action still waiting for the previous one to finish
+    is replaced by a newer one (e.g. a burst of SetSpeed from a dimmer).
+    """
+
+    def __init__(self, address: str, token: Optional[str] = None, max_concurrency: int = 4,
+                 timeout: float = 5, retries: int = 2):
+        self.base_url = f"http://{address}/v2"
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.retries = retries
+
+        self.session = requests.Session()
+        if token:
+            self.session.headers["BOND-Token"] = token
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount("http://", adapter)
+        self.executor = CoalescingExecutor(max_concurrency, name=f"bond-{address}")
+
+        self.failed = 0
+
+    def request(self, method: str, path: str, body: Optional[Dict[str, Any]] = None, retries: Optional[int] = None) -> Any:
+        """Send a request synchronously and return the decoded JSON body."""
+        return json_request(self.session, method, self.base_url + path, body, self.timeout,
+                            self.retries if retries is None else retries)
+
+    def devices(self) -> List[str]:
+        """List the ids of the devices known to the bridge."""
+        return [device_id for device_id in self.request("GET", "/devices", retries=0) if not device_id.startswith("_")]
+
+    def states(self, device_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Fetch the state of several devices concurrently. Devices whose state could not be fetched are left out."""
+        def fetch(device_id):
+            try:
+                return self.request("GET", f"/devices/{device_id}/state")
+            except requests.RequestException as e:
+                logger.error("Failed to fetch state of Bond device %s: %s", device_id, e)
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+            states = dict(zip(device_ids, pool.map(fetch, device_ids)))
+        return {device_id: state for device_id, state in states.items() if state is not None}
+
+    def action(self, device_id: str, action: str, argument: Optional[int] = None):
+        """Queue a device action. Returns immediately."""
+        body = {} if argument is None else {"argument": argument}
+        path = f"/devices/{device_id}/actions/{action}"
+
+        def send():
+            logger.info("Bond PUT %s %s", path, body)
+            try:
+                self.request("PUT", path, body)
+            except requests.RequestException as e:
+                self.failed += 1
+                logger.error("Bond action %s failed: %s", path, e)
+
+        self.executor.submit(device_id, send)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "depth": self.executor.queue_depth,
+            "in_flight": self.executor.in_flight,
+            "submitted": self.executor.submitted,
+            "coalesced": self.executor.coalesced,
+            "failed": self.failed,
+        }
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
+
+
+class BondPushListener:
+    """
+    Bond Push UDP Protocol (BPUP) listener.
+
+    The bridge pushes state changes to whoever sent it a keepalive datagram in the last couple of
+    minutes, so we send one every `keepalive` seconds. The bridge acknowledges each keepalive -
+    if no datagram arrives within `ack_timeout` the keepalive is considered missed and resent.
+    """
+
+    def __init__(self, address: str, port: int = 30007, keepalive: float = 60, ack_timeout: float = 5,
+                 on_message: Optional[Callable[[Dict[str, Any]], None]] = None):
+        self.address = address
+        self.port = port
+        self.keepalive = keepalive
+        self.ack_timeout = ack_timeout
+        self.on_message = on_message
+        self.running = False
+        self.sock: Optional[socket.socket] = None
+
+        self.missed_keepalives = 0
+        self.last_received: Optional[float] = None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.connect((self.address, self.port))
+        self.thread = threading.Thread(target=self._listen_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.sock:
+            self.sock.close()
+
+    def _listen_loop(self):
+        next_keepalive = 0.0
+        ack_deadline = None
+        consecutive_misses = 0
+        while self.running:
+            now = time.monotonic()
+            if ack_deadline and now >= ack_deadline:
+                self.missed_keepalives += 1
+                consecutive_misses += 1
+                (logger.warning if consecutive_misses == 1 else logger.debug)("Bond %s did not acknowledge keepalive - resending", self.address)
+                next_keepalive = now
+                ack_deadline = None
+            if now >= next_keepalive:
+                try:
+                    self.sock.send(b"\n")
+                except OSError as e:
+                    logger.error("Failed to send Bond keepalive: %s", e)
+                next_keepalive = now + self.keepalive
+                ack_deadline = ack_deadline or now + self.ack_timeout
+
+            try:
+                self.sock.settimeout(max(0.01, min(next_keepalive, ack_deadline or next_keepalive) - now))
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                continue
+            except OSError as e:
+                # e.g. ICMP port unreachable while the bridge reboots
+                if self.running:
+                    logger.error("Bond listener error: %s", e)
+                    time.sleep(self.ack_timeout)
+                continue
+
+            self.last_received = time.monotonic()
+            ack_deadline = None
+            if consecutive_misses:
+                logger.info("Bond %s is pushing again after %d missed keepalives", self.address, consecutive_misses)
+                consecutive_misses = 0
+            try:
+                message = json.loads(data)
+            except ValueError:
+                logger.warning("Unparsable Bond push message: %r", data)
+                continue
+            if "t" in message and self.on_message:  # Messages without a topic are keepalive acknowledgements
+                try:
+                    self.on_message(message)
+                except Exception as e:
+                    logger.exception("Error handling Bond push message %s: %s", message, e)
+
+
 class Bond(Service):
-    def __init__(self, address: str, port: int, token: str):
+    def __init__(self, address: str, port: int = 30007, token: str = None, keepalive: float = 60,
+                 max_concurrency: int = 4, timeout: float = 5, retries: int = 2):
         """
         Initialize a Bond connection.
         
         Args:
             address: The IP address of the Bond device
-            port: The UDP port to listen on for state updates
+            port: The UDP port of the Bond push protocol (BPUP)
             token: The Bond API token
+            keepalive: Seconds between BPUP keepalives
+            max_concurrency: Maximum number of HTTP requests in flight to the bridge
+            timeout: Seconds to wait for an HTTP response
+            retries: Times to retry an HTTP request that failed to connect or timed out
         """
         super().__init__()
         logger.info("Creating Bond service (%s:%d)", address, port)
@@ -61,22 +235,55 @@ class Bond(Service):
         self.port = port
         self.token = token
 
-        self.listener = ShellListener()
-        
+        # device id -> devices interested in its state pushes
+        self._devices: Dict[str, List[BondDevice]] = {}
+        self.listener = BondPushListener(address, port, keepalive, on_message=self._on_push)
+        self.client = BondClient(address, token, max_concurrency, timeout, retries)
 
     def device(self, device_id: str) -> BondDevice:
         return BondDevice(self, device_id)
 
+    def register_device(self, device: BondDevice):
+        self._devices.setdefault(str(device.device_id), []).append(device)
+
+    def _on_push(self, message: Dict[str, Any]):
+        """Dispatch a push message (topic "devices/<id>/state") to the devices registered for that id."""
+        topic = message["t"].split("/")
+        if len(topic) == 3 and topic[0] == "devices" and topic[2] == "state":
+            for device in self._devices.get(topic[1], ()):
+                device._on_state(message.get("b", {}))
+
     def start(self):
-        # Create the listener for state updates with a shorter sleep time for more responsive updates
-        self.listener.shell_command = f"(while true; do echo ; sleep 60; done) | nc -u {self.address} {self.port}"
+        self._prefetch()
         logger.info("Starting Bond listener for %s:%d", self.address, self.port)
         self.listener.start()
 
+    def _prefetch(self):
+        """Seed every bound device with its current state, so bindings start in sync rather than on the first push."""
+        if not self._devices:
+            return
+        try:
+            available = set(self.client.devices())
+        except (requests.RequestException, ValueError) as e:
+            logger.error("Failed to list Bond devices on %s - values will arrive with the first push: %s", self.address, e)
+            return
+
+        unknown = sorted(set(self._devices) - available)
+        if unknown:
+            logger.warning("Bond %s has no devices with ids %s (available: %s)", self.address, unknown, sorted(available))
+
+        start = time.monotonic()
+        states = self.client.states([device_id for device_id in self._devices if device_id in available])
+        for device_id, state in states.items():
+            for device in self._devices[device_id]:
+                device._on_state(state)
+        logger.info("Fetched %d Bond device states in %.2fs", len(states), time.monotonic() - start)
+
     def stop(self):
         """Stop the listener and clean up resources."""
         logger.info("Stopping Bond listener")
         self.listener.stop()
+        self.client.close()
 
-    def reduct(self,x):
-        return x.replace(self.token,"<TOKEN>")
+    def stats(self) -> Dict[str, int]:
+        return self.client.stats()
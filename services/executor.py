@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple, Type
+
+import requests
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class CoalescingExecutor:
+    """
+    Runs jobs on a bounded pool of worker threads, so slow I/O never runs on the thread that delivered an event.
+
+    Jobs are submitted with a key. Jobs with the same key run one at a time, in order, and unless submitted
+    with coalesce=False, the jobs still waiting behind a running one are replaced by a newer submission
+    for that key (latest wins).
+    """
+
+    def __init__(self, max_workers: int = 4, name: str = "worker"):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._pending = {}  # key -> deque of jobs waiting to run
+        self._running = set()  # keys with a worker currently assigned
+        self._active = 0  # jobs currently running
+
+        self.submitted = 0
+        self.coalesced = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(jobs) for jobs in self._pending.values())
+
+    @property
+    def in_flight(self) -> int:
+        return self._active
+
+    def submit(self, key: Hashable, job: Callable[[], Any], coalesce: bool = True):
+        with self._lock:
+            self.submitted += 1
+            jobs = self._pending.setdefault(key, deque())
+            if coalesce:
+                self.coalesced += len(jobs)
+                jobs.clear()
+            jobs.append(job)
+            if key in self._running:
+                return  # The worker running this key picks it up when it's done
+            self._running.add(key)
+        self._executor.submit(self._run, key)
+
+    def _run(self, key: Hashable):
+        while True:
+            with self._lock:
+                jobs = self._pending.get(key)
+                if not jobs:
+                    self._pending.pop(key, None)
+                    self._running.discard(key)
+                    return
+                job = jobs.popleft()
+                self._active += 1
+            try:
+                job()
+            except Exception as e:
+                logger.exception("Error in background job %s: %s", key, e)
+            finally:
+                with self._lock:
+                    self._active -= 1
+
+    def shutdown(self, wait: bool = False):
+        self._executor.shutdown(wait=wait, cancel_futures=True)
+
+
+def retry_call(func: Callable[[], Any], retries: int = 2, backoff: float = 0.5, exceptions: Tuple[Type[BaseException], ...] = (Exception,)) -> Any:
+    """Call func, retrying up to `retries` times with jittered exponential backoff on the given exceptions."""
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except exceptions as e:
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt * random.uniform(0.5, 1.0)
+            logger.debug("Attempt %d failed (%s) - retrying in %.2fs", attempt + 1, e, delay)
+            time.sleep(delay)
+
+
+def json_request(session: requests.Session, method: str, url: str, body: Optional[Dict[str, Any]] = None,
+                 timeout: float = 10, retries: int = 2) -> Any:
+    """Send a JSON request (retrying connection errors and timeouts) and return the decoded JSON body, or None if empty."""
+    def send():
+        response = session.request(method, url, json=body, timeout=timeout)
+        response.raise_for_status()
+        return response.json() if response.content else None
+    return retry_call(send, retries, exceptions=(requests.ConnectionError, requests.Timeout))
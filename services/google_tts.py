@@ -13,11 +13,24 @@ else:
     from .service import Service
 
 from logger import get_logger
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import struct
 import subprocess
 import tempfile
+import threading
+import time
+import wave
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+import numpy as np
 from google.cloud import texttospeech
 from google.oauth2 import service_account
-from typing import Optional, Dict, Any
+from typing import BinaryIO, Callable, Iterator, Optional, Dict, Any, Tuple
 
 from pytimeparse.timeparse import timeparse
 
@@ -25,35 +38,260 @@ from pytimeparse.timeparse import timeparse
 # Get logger for this module
 logger = get_logger(__name__)
 
+# Format of the audio sent to the player
+SAMPLE_RATE = 44100
+CHANNELS = 2
+CHUNK_FRAMES = 8192  # Frames converted and written to the player at a time
+
+
+def wav_header(frames: int, rate: int = SAMPLE_RATE, channels: int = CHANNELS) -> bytes:
+    """Header of a 16-bit PCM WAV file with the given number of frames"""
+    data_size = frames * channels * 2
+    return struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + data_size, b"WAVE", b"fmt ", 16, 1, channels,
+                       rate, rate * channels * 2, channels * 2, 16, b"data", data_size)
+
+
+def to_playable_wav(audio: bytes) -> Iterator[bytes]:
+    """
+    Convert a 16-bit PCM WAV to SAMPLE_RATE / CHANNELS, yielding the header and then the audio in chunks.
+
+    The API is asked for SAMPLE_RATE already, so usually this only duplicates the mono channel. Other
+    rates are resampled by linear interpolation.
+    """
+    with wave.open(io.BytesIO(audio)) as source:
+        if source.getsampwidth() != 2:
+            raise ValueError(f"Unsupported sample width {source.getsampwidth()}")
+        channels, rate, frames = source.getnchannels(), source.getframerate(), source.getnframes()
+        data = source.readframes(frames)
+    samples = np.frombuffer(data, dtype="<i2").reshape(-1, channels)
+    frames = len(samples)  # The header of streamed responses may not hold the real length
+
+    out_frames = frames if rate == SAMPLE_RATE else int(frames * SAMPLE_RATE / rate)
+    yield wav_header(out_frames)
+    for start in range(0, out_frames, CHUNK_FRAMES):
+        if rate == SAMPLE_RATE:
+            chunk = samples[start:start + CHUNK_FRAMES]
+        else:
+            positions = np.arange(start, min(start + CHUNK_FRAMES, out_frames)) * (rate / SAMPLE_RATE)
+            index = positions.astype(np.int64)
+            fraction = (positions - index)[:, None]
+            before = samples[index].astype(np.float32)
+            after = samples[np.minimum(index + 1, frames - 1)].astype(np.float32)
+            chunk = np.round(before + (after - before) * fraction).astype("<i2")
+        if channels == 1:
+            chunk = np.repeat(chunk, CHANNELS, axis=1)
+        elif channels > CHANNELS:
+            chunk = chunk[:, :CHANNELS]
+        yield np.ascontiguousarray(chunk, dtype="<i2").tobytes()
+
+class TTSCache:
+    """
+    Size-bounded on-disk cache of the final (playable) audio, keyed by a hash of everything that
+    determines it. Files are written atomically and evicted least recently used first.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        # file name -> size, least recently used first
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".tmp"):
+                os.unlink(path)  # Left over by an interrupted write
+            elif name.endswith(".wav"):
+                stat = os.stat(path)
+                files.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+        self.size = sum(self._entries.values())
+        self._evict()
+
+    @staticmethod
+    def key(*parts: Any) -> str:
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+    def open(self, key: str) -> Optional[BinaryIO]:
+        """Open the cached audio of key for reading, or return None on a miss."""
+        name = key + ".wav"
+        with self.lock:
+            if name not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(name)
+            self.hits += 1
+        path = os.path.join(self.directory, name)
+        try:
+            f = open(path, "rb")
+            os.utime(path)  # Keep the LRU order across restarts
+            return f
+        except OSError as e:
+            logger.warning("Dropping unreadable TTS cache entry %s: %s", name, e)
+            self.discard(key)
+            return None
+
+    @contextmanager
+    def writer(self, key: str) -> Iterator[BinaryIO]:
+        """Write the audio of key - it replaces the cached entry only once the block completes without error."""
+        name = key + ".wav"
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                yield f
+            size = os.path.getsize(tmp)
+            os.replace(tmp, os.path.join(self.directory, name))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        with self.lock:
+            self.size += size - self._entries.pop(name, 0)
+            self._entries[name] = size
+            self._evict()
+
+    def __contains__(self, key: str) -> bool:
+        return key + ".wav" in self._entries
+
+    def retain(self, keys) -> int:
+        """Drop every entry whose key is not in keys. Returns the number dropped."""
+        names = {key + ".wav" for key in keys}
+        with self.lock:
+            stale = [name for name in self._entries if name not in names]
+        for name in stale:
+            self.discard(name[:-len(".wav")])
+        return len(stale)
+
+    def discard(self, key: str):
+        name = key + ".wav"
+        with self.lock:
+            if name in self._entries:
+                self.size -= self._entries.pop(name)
+        try:
+            os.unlink(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._entries:
+            name, size = self._entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+            logger.debug("Evicted TTS cache entry %s", name)
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self._entries), "bytes": self.size, "hits": self.hits, "misses": self.misses}
+
+
+class PlaybackQueue:
+    """
+    Plays announcements on one speaker, one at a time, on a worker thread of its own.
+
+    Higher priority announcements play first (in arrival order within a priority). Queuing a text that is
+    already waiting merges the two, keeping the higher priority, and announcements that waited longer than
+    max_age are dropped rather than played late.
+    """
+
+    def __init__(self, play: Callable[[str], None], max_age: float = 60):
+        self.play = play
+        self.max_age = max_age
+        self.condition = threading.Condition()
+        self._heap = []  # (-priority, sequence, text)
+        self._queued: Dict[str, Dict[str, Any]] = {}  # text -> {priority, sequence, enqueued, callbacks}
+        self._sequence = itertools.count()
+
+        self.played = 0
+        self.merged = 0
+        self.expired = 0
+
+        self.thread = threading.Thread(target=self._play_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, text: str, priority: int = 0, on_done: Optional[Callable[[], None]] = None):
+        with self.condition:
+            entry = self._queued.get(text)
+            if entry:
+                self.merged += 1
+                entry["enqueued"] = time.monotonic()
+                if on_done:
+                    entry["callbacks"].append(on_done)
+                if priority <= entry["priority"]:
+                    return
+                # Re-queue with the higher priority - the old heap item is skipped when popped
+                entry["priority"] = priority
+            else:
+                entry = self._queued[text] = {"priority": priority, "enqueued": time.monotonic(), "callbacks": [on_done] if on_done else []}
+            entry["sequence"] = next(self._sequence)
+            heapq.heappush(self._heap, (-priority, entry["sequence"], text))
+            self.condition.notify()
+
+    @property
+    def depth(self) -> int:
+        return len(self._queued)
+
+    def _next(self) -> Tuple[str, Dict[str, Any]]:
+        with self.condition:
+            while True:
+                while not self._heap:
+                    self.condition.wait()
+                _, sequence, text = heapq.heappop(self._heap)
+                entry = self._queued.get(text)
+                if entry and entry["sequence"] == sequence:  # Otherwise superseded by a merge
+                    del self._queued[text]
+                    return text, entry
+
+    def _play_loop(self):
+        while True:
+            text, entry = self._next()
+            try:
+                age = time.monotonic() - entry["enqueued"]
+                if age > self.max_age:
+                    self.expired += 1
+                    logger.warning("Dropping TTS %r - it waited %.0fs", text, age)
+                    continue
+                self.play(text)
+                self.played += 1
+            except Exception as e:
+                logger.error(f"Error in TTS playback: {str(e)}")
+            finally:
+                for callback in entry["callbacks"]:
+                    callback()
+
+
 class GoogleTTSConnector(Connector):
     """Connector for Google Text-to-Speech that sends audio to a HomePod via raop_play."""
     
-    def __init__(self, tts: 'GoogleTTS', text: str):
+    def __init__(self, tts: 'GoogleTTS', text: str, priority: int = 0):
         super().__init__(process_same_value_events=True)
         logger.info(f"TTS Connector created for {text=}")
         self.tts = tts
         self.text = text
+        self.priority = priority
         self.name = f"GoogleTTS<{text}>"
     
     def _set_action(self, value: bool) -> None:
-        """Override _set_action to play the synthesized audio on HomePod using pipes."""
-        logger.info(f"Running TTS command {self.text=}")
-        try:
-            if not value:
-                return
-            # Get processed audio directly from synthesize_speech
-            self.tts.speak(self.text)
-            
-        except Exception as e:
-            logger.error(f"Error in TTS playback: {str(e)}")
-        finally:
-            # Reset state after playback completes or on error
-            self.set(False, act=False)
+        """Override _set_action to queue the announcement - it plays on the speaker's playback worker."""
+        if not value:
+            return
+        logger.info(f"Queuing TTS {self.text=} {self.priority=}")
+        # Reset state after playback completes or on error
+        self.tts.queue.put(self.text, self.priority, on_done=lambda: self.set(False, act=False))
 
 class GoogleTTS(Service):
     """Service for Google Cloud Text-to-Speech integration."""
     
-    def __init__(self, homepod_ip: str, volume: 80, play_command: str = './services/libraop/build/raop_play-linux-aarch64', credentials: Optional[Dict[str, Any]] = None, credentials_file: Optional[str] = None, after="00:00", before= "24:00"):
+    def __init__(self, homepod_ip: str, volume: 80, play_command: str = './services/libraop/build/raop_play-linux-aarch64', credentials: Optional[Dict[str, Any]] = None, credentials_file: Optional[str] = None, after="00:00", before= "24:00",
+                 cache_dir: str = "~/.cache/connector/tts", cache_size_mb: float = 100, warm_workers: int = 4, prune_cache: bool = True,
+                 max_queue_age: float = 60):
         """
         Initialize Google TTS service.
         
@@ -64,6 +302,11 @@ class GoogleTTS(Service):
                         Required keys: type, project_id, private_key_id, private_key, client_email, client_id
             credentials_file: Optional path to a JSON file containing the credentials.
                             If both credentials and credentials_file are provided, credentials takes precedence.
+            cache_dir: Directory of the synthesized audio cache
+            cache_size_mb: Size limit of the cache (0 disables it)
+            warm_workers: Number of texts synthesized in parallel when warming the cache at start
+            prune_cache: Drop cached audio of texts no connector uses anymore when warming the cache
+            max_queue_age: Seconds an announcement may wait for the speaker before it is dropped
         """
         super().__init__()
 
@@ -72,6 +315,13 @@ class GoogleTTS(Service):
         self.play_command = play_command
         self.after = timeparse(after, granularity="minutes")
         self.before = timeparse(before, granularity="minutes")
+        self.cache = TTSCache(cache_dir, int(cache_size_mb * 1024 * 1024)) if cache_size_mb else None
+        self.warm_workers = warm_workers
+        self.prune_cache = prune_cache
+        self.texts = set()  # Texts of the connectors created so far
+        self._key_locks: Dict[str, threading.Lock] = {}  # Serialize synthesis of the same audio
+        self._key_locks_lock = threading.Lock()
+        self.queue = PlaybackQueue(self.speak, max_queue_age)
         
         # Initialize credentials if provided
         if credentials:
@@ -97,6 +347,7 @@ class GoogleTTS(Service):
             )
             audio_config = texttospeech.AudioConfig(
                 audio_encoding=texttospeech.AudioEncoding.LINEAR16,
+                sample_rate_hertz=SAMPLE_RATE,
                 speaking_rate=1.2,  
                 pitch=0.0
             )
@@ -107,14 +358,15 @@ class GoogleTTS(Service):
             )
             audio_config = texttospeech.AudioConfig(
                 audio_encoding=texttospeech.AudioEncoding.LINEAR16,
+                sample_rate_hertz=SAMPLE_RATE,
                 speaking_rate=1,  
                 pitch=0.0
             )
         return voice, audio_config
 
-    def synthesize_speech(self, text: str, output_file: str = None) -> bytes:
+    def synthesize_speech(self, text: str, output_file: str = None) -> Optional[bytes]:
         """
-        Synthesize speech from text and process with ffmpeg.
+        Synthesize speech from text as a 44.1kHz 16-bit stereo WAV.
         If output_file is provided, save to file. Otherwise return processed audio bytes.
         
         Args:
@@ -124,6 +376,16 @@ class GoogleTTS(Service):
         Returns:
             bytes: The processed audio data if output_file is None
         """
+        if output_file:
+            with open(output_file, "wb") as f:
+                for chunk in self._synthesize_chunks(text):
+                    f.write(chunk)
+            logger.info(f"Processed audio saved to: {output_file}")
+            return None
+        return b"".join(self._synthesize_chunks(text))
+
+    def _synthesize_chunks(self, text: str) -> Iterator[bytes]:
+        """Synthesize text and yield the WAV header followed by the audio, a chunk at a time."""
         try:
             # Check if input is SSML
             if text.strip().lower().startswith('<speak>'):
@@ -142,38 +404,110 @@ class GoogleTTS(Service):
                 voice=voice,
                 audio_config=audio_config
             )
-            
-            # Process audio with ffmpeg using pipes
-            ffmpeg_cmd = ['/bin/ffmpeg', '-i', '-', '-ar', '44100', '-ac', '2', 
-                         '-sample_fmt', 's16', '-f', 'wav']
-            
-            if output_file:
-                ffmpeg_cmd.append(output_file)
-                subprocess.run(ffmpeg_cmd, input=response.audio_content, check=True)
-                logger.info(f"Processed audio saved to: {output_file}")
-                return None
-            else:
-                ffmpeg_cmd.append('-')  # Output to stdout
-                process = subprocess.run(ffmpeg_cmd, input=response.audio_content, 
-                                      capture_output=True, check=True)
-                return process.stdout
-                
         except Exception as e:
             logger.error(f"Error synthesizing speech: {str(e)}")
             raise
+        yield from to_playable_wav(response.audio_content)
     
-    def device(self, text: str) -> GoogleTTSConnector:
-        """Create a new TTS connector for a specific HomePod."""
-        return GoogleTTSConnector(self, text)
+    # Describes the processing applied after synthesis - change it when that changes to invalidate the cache
+    OUTPUT_FORMAT = f"wav/{SAMPLE_RATE}/{CHANNELS}/s16"
+
+    def cache_key(self, text: str) -> str:
+        voice, audio_config = self.get_voice_params(text)
+        return TTSCache.key(text, self.OUTPUT_FORMAT,
+                            type(voice).to_dict(voice), type(audio_config).to_dict(audio_config))
+
+    def audio_chunks(self, text: str) -> Iterator[bytes]:
+        """The playable audio of text, a chunk at a time - from the cache if it was synthesized before."""
+        if not self.cache:
+            yield from self._synthesize_chunks(text)
+            return
+        key = self.cache_key(text)
+        with self._key_locks_lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:  # If the same text is being synthesized (e.g. by warm()), wait for it instead of synthesizing again
+            cached = self.cache.open(key)
+            if cached is None:
+                with self.cache.writer(key) as f:
+                    for chunk in self._synthesize_chunks(text):
+                        f.write(chunk)
+                        yield chunk
+                return
+        logger.debug("TTS cache hit for %r", text)
+        with cached:
+            while chunk := cached.read(CHUNK_FRAMES * CHANNELS * 2):
+                yield chunk
+
+    def audio(self, text: str) -> bytes:
+        """The playable audio of text - from the cache if it was synthesized before."""
+        return b"".join(self.audio_chunks(text))
+
+    def start(self):
+        if self.cache and self.texts:
+            thread = threading.Thread(target=self.warm, args=(sorted(self.texts),))
+            thread.daemon = True
+            thread.start()
+
+    def warm(self, texts):
+        """Synthesize the texts missing from the cache in a bounded thread pool, and optionally drop the audio of other texts."""
+        keys = {self.cache_key(text): text for text in texts}
+        if self.prune_cache:
+            dropped = self.cache.retain(keys)
+            if dropped:
+                logger.info("Dropped %d cached TTS entries no longer in config", dropped)
+        missing = [text for key, text in keys.items() if key not in self.cache]
+        if not missing:
+            logger.info("TTS cache is warm (%d texts)", len(keys))
+            return
+
+        logger.info("Warming TTS cache: %d of %d texts to synthesize", len(missing), len(keys))
+        done = failed = 0
+        with ThreadPoolExecutor(max_workers=self.warm_workers, thread_name_prefix="tts-warm") as pool:
+            futures = {pool.submit(self.audio, text): text for text in missing}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                    done += 1
+                    logger.debug("Warmed TTS cache %d/%d: %r", done, len(missing), futures[future])
+                except Exception as e:
+                    failed += 1
+                    logger.warning("Failed to pre-synthesize %r: %s", futures[future], e)
+        logger.info("Warmed TTS cache: %d synthesized, %d failed", done, failed)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            **(self.cache.stats() if self.cache else {}),
+            "queued": self.queue.depth,
+            "played": self.queue.played,
+            "merged": self.queue.merged,
+            "expired": self.queue.expired,
+        }
+
+    def device(self, text: str, priority: int = 0) -> GoogleTTSConnector:
+        """
+        Create a new TTS connector for a specific HomePod.
+        Announcements with a higher priority (e.g. security alerts) play before queued lower priority ones.
+        """
+        self.texts.add(text)
+        return GoogleTTSConnector(self, text, priority)
 
     def speak(self, text: str):
-        audio_data = self.synthesize_speech(text)
-        
-        # Play the processed audio on HomePod using pipes
+        # Start the player first, so it connects to the HomePod while the audio is being synthesized
         cmd = [self.play_command, self.homepod_ip, "-v", str(self.volume), "-"]
         logger.info(f"Playing audio on HomePod {self.homepod_ip} {self.volume}")
         process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
-        process.communicate(input=audio_data)
+        try:
+            # Stream the audio to the player as it becomes available
+            for chunk in self.audio_chunks(text):
+                process.stdin.write(chunk)
+        except BrokenPipeError:
+            logger.error("Player exited before all the audio was written")
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            process.wait()
 
 
 if __name__ == "__main__":
@@ -195,11 +529,8 @@ if __name__ == "__main__":
         credentials_path = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "data", "homekitai-58ec470d4bd3.json")
         tts_service = GoogleTTS(homepod_ip, 50, credentials_file=credentials_path)
         
-        # Create a connector for the specified HomePod
-        connector = tts_service.device(text=message)
-        
-        # Speak the message
-        connector.set(True)
+        # Speak the message (directly - a connector would queue it on a daemon thread)
+        tts_service.speak(message)
         
     except Exception as e:
         logger.error(f"Error: {str(e)}")
@@ -1,29 +1,39 @@
 import requests
+from requests.adapters import HTTPAdapter
 from .service import Service
 from .connector import Connector
+from .executor import CoalescingExecutor, retry_call
 from logger import get_logger
-from threading import Thread
+from collections import deque
+from threading import Lock
+from urllib.parse import urlsplit
+import time
 logger = get_logger(__name__)
 import logging
 import urllib3
 
 class HTTPRequestConnector(Connector):
-    def __init__(self, url, method: str = "GET", headers: dict = None, body: str = None, debug=False):
+    def __init__(self, http: 'HTTP', url, method: str = "GET", headers: dict = None, body: str = None, debug=False,
+                 coalesce: bool = False):
         super().__init__()  # Initialize with no value
+        self.http = http
         self.url = url
         self.method = method.upper()
         self.headers = headers or {}
         self.body = body
         self.debug = debug
+        self.coalesce = coalesce
         logger.info(f"Created HTTPRequestConnector for {self.method} {self.url}")
 
     def _set_action(self, value):
-        Thread(target=lambda: self.send(value)).start()
+        # Requests of a connector are sent one at a time, in order. With coalesce, a value still waiting
+        # for the previous request is replaced by the newer one (latest wins)
+        self.http.executor.submit(self, lambda: self.send(value), coalesce=self.coalesce)
 
     def send(self, value):
         try:
             if self.debug: logger.info(f"Sending HTTP {self.method} to {self.url} with data: {value}")
-            response = requests.request(
+            response = self.http.request(
                 self.method,
                 self.url,
                 headers=self.headers,
@@ -34,15 +44,83 @@ class HTTPRequestConnector(Connector):
             logger.error(f"HTTP request failed: {e}")
 
 class HTTP(Service):
-    def __init__(self,debug=False):
+    def __init__(self, debug=False, max_workers: int = 8, timeout: float = 10, retries: int = 2, backoff: float = 0.5):
+        """
+        Args:
+            debug: Log every request and response
+            max_workers: Maximum number of requests in flight
+            timeout: Seconds to wait for a response
+            retries: Times to retry a request that failed to connect, timed out or got a 5xx response
+            backoff: Seconds before the first retry, doubling with each retry
+        """
         super().__init__()
         self.debug = debug
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.executor = CoalescingExecutor(max_workers, name="http")
         logging.getLogger("urllib3").setLevel(logging.DEBUG if debug else logging.WARNING)
 
-    def device(self, url, method: str = "GET", headers: dict = None, body: str = None) -> Connector:
+        self._sessions = {}  # scheme://host:port -> Session (a keep-alive connection pool per host)
+        self._sessions_lock = Lock()
+        self._latencies = deque(maxlen=1000)  # Seconds, of the most recent requests
+        self.failed = 0
+
+    def session(self, url: str) -> requests.Session:
+        parts = urlsplit(url)
+        origin = f"{parts.scheme}://{parts.netloc}"
+        with self._sessions_lock:
+            if origin not in self._sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.executor.max_workers)
+                session.mount(origin, adapter)
+                self._sessions[origin] = session
+            return self._sessions[origin]
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Send a request over the pooled session of its host, with a timeout and retries with backoff."""
+        session = self.session(url)
+
+        def send():
+            response = session.request(method, url, timeout=self.timeout, **kwargs)
+            if response.status_code >= 500:
+                raise requests.HTTPError(f"{response.status_code} {response.reason} for {url}", response=response)
+            return response
+
+        start = time.monotonic()
+        try:
+            return retry_call(send, self.retries, self.backoff,
+                              exceptions=(requests.ConnectionError, requests.Timeout, requests.HTTPError))
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self._latencies.append(time.monotonic() - start)
+
+    def stats(self) -> dict:
+        """In-flight requests, queue depth and latency percentiles (in milliseconds, of the last 1000 requests)"""
+        latencies = sorted(self._latencies)
+        percentiles = {f"p{p}": round(latencies[min(len(latencies) - 1, len(latencies) * p // 100)] * 1000, 1)
+                       for p in (50, 90, 99)} if latencies else {}
+        return {
+            "in_flight": self.executor.in_flight,
+            "queue_depth": self.executor.queue_depth,
+            "submitted": self.executor.submitted,
+            "coalesced": self.executor.coalesced,
+            "failed": self.failed,
+            **percentiles,
+        }
+
+    def device(self, url, method: str = "GET", headers: dict = None, body: str = None, coalesce: bool = False) -> Connector:
         """
         Returns a Connector. When set, it sends the HTTP request.
         If dynamic_body is True, the value set is used as the request body.
+        If coalesce is True, only the latest of the values set while a request is in flight is sent.
         """
-        return HTTPRequestConnector(url, method=method, headers=headers, body=body, debug=self.debug)
-        
+        return HTTPRequestConnector(self, url, method=method, headers=headers, body=body, debug=self.debug,
+                                    coalesce=coalesce)
+
+    def stop(self):
+        self.executor.shutdown()
+        for session in self._sessions.values():
+            session.close()
@@ -4,9 +4,12 @@ import sys
 import time
 import threading
 import socket
+import codecs
+import random
 import re
 
-from typing import List, Optional
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
 
 from .connector import Connector
 from .service import Service
@@ -15,15 +18,29 @@ from logger import get_logger
 # Get logger for this module
 logger = get_logger(__name__)
 
+# (command type, integration id, component) - e.g. ("OUTPUT", "12", "1") for "~OUTPUT,12,1,50.00"
+EventKey = Tuple[str, str, str]
+
+# Connection states (published through Lutron.health)
+DISCONNECTED = "disconnected"
+CONNECTING = "connecting"
+CONNECTED = "connected"
+
 class LutronConnector(Connector):
-    """Base class for Lutron-specific connectors that need to process events."""
-    
-    def process_event(self, line: str) -> None:
+    """Base class for Lutron-specific connectors that need to process events.
+
+    Handlers that set `key` are dispatched through the Lutron event index and only see
+    lines for that (command type, integration id, component). Handlers without a key
+    receive every line.
+    """
+    key: Optional[EventKey] = None
+
+    def process_event(self, line: str, args: List[str]) -> None:
         pass
 
-    def safely_process_event(self, line: str) -> bool:
+    def safely_process_event(self, line: str, args: List[str]) -> bool:
         try:
-            return self.process_event(line)
+            return self.process_event(line, args)
         except Exception as e:
             import traceback
             logger.error(f"Error processing event in {self.name}: {str(e)}\n{traceback.format_exc()}")
@@ -36,6 +53,7 @@ class LutronDevice(LutronConnector):
         self.lutron = lutron
         self.device_id = device_id
         self.name = f"LutronDevice<{device_id}>"
+        self.key = ("OUTPUT", str(device_id), "1")
         self.lutron.register_handler(self)
     
     def _set_action(self, value: float) -> None:
@@ -43,11 +61,11 @@ class LutronDevice(LutronConnector):
         # Convert from our 0-1 range to Lutron's 0-100 range
         self.lutron.send_command(f"#OUTPUT,{self.device_id},1,{(value * 100):.2f}")
 
-    def process_event(self, line: str) -> None:
+    def process_event(self, line: str, args: List[str]) -> None:
         """Process OUTPUT events for this device."""
         # OUTPUT event: ~OUTPUT,device_id,1,value
-        if m := re.match(rf"~OUTPUT,{self.device_id},1,(\d+)", line):
-            value = int(m.group(1))
+        if args:
+            value = int(float(args[0]))
             self.set(value / 100.0, act=False)
             return True
 
@@ -57,17 +75,18 @@ class LutronSysvar(LutronConnector):
         self.lutron = lutron
         self.sysvar_id = sysvar_id
         self.name = f"LutronSysvar<{sysvar_id}>"
+        self.key = ("SYSVAR", str(sysvar_id), "1")
         self.lutron.register_handler(self)
     
     def _set_action(self, value: int) -> None:
         """Override _set_action to send Lutron command when value changes"""
         self.lutron.send_command(f"#SYSVAR,{self.sysvar_id},1,{value}")
       
-    def process_event(self, line: str) -> None:
+    def process_event(self, line: str, args: List[str]) -> None:
         """Process SYSVAR events for this sysvar."""
         # SYSVAR event: ~SYSVAR,sysvar_id,1,value
-        if m := re.match(rf"~SYSVAR,{self.sysvar_id},1,(\d+)", line):
-            value = int(m.group(1))
+        if args:
+            value = int(float(args[0]))
             self.set(value, act=False)
             return True
 
@@ -81,6 +100,7 @@ class LutronKeypad(LutronConnector):
         self.click_type = click_type
         self._value = False
         self.name = f"LutronKeypad<{keypad_id}, {button_id}, {click_type}>"
+        self.key = ("DEVICE", str(keypad_id), str(button_id))
 
         self.lutron.register_handler(self)
         
@@ -92,10 +112,10 @@ class LutronKeypad(LutronConnector):
             self.lutron.send_command(cmd)
             self._value = False
 
-    def process_event(self, line: str) -> None:
+    def process_event(self, line: str, args: List[str]) -> None:
         """Process DEVICE events for this keypad button."""
         # DEVICE event: ~DEVICE,keypad_id,button_id,event_type
-        if m := re.match(rf"~DEVICE,{self.keypad_id},{self.button_id},{self.click_type}", line):
+        if args and args[0] == str(self.click_type):
             self.set(True, act=False)
             return True
 
@@ -117,114 +137,465 @@ class LutronPattern(LutronConnector):
         super().__init__()  # Initialize with no value
         self.lutron = lutron
         self.pattern = pattern
+        self._regex = re.compile(pattern)
         self.name = f"LutronSysvar<{pattern}>"
         self.lutron.register_handler(self)
           
-    def process_event(self, line: str) -> None:
-        """Process SYSVAR events for this sysvar."""
-        # SYSVAR event: ~SYSVAR,sysvar_id,1,value
-        if m := re.match(self.pattern, line):
+    def process_event(self, line: str, args: List[str]) -> None:
+        """Process any line matching the pattern (slow path - not indexed)."""
+        if m := self._regex.match(line):
             value = m.groups()[0] if m.groups() else m.string
             self.set(value, act=False)
             return True
         
-class Lutron(Service):
-    def __init__(self, host: str, port: int, username: str, password: str):
-        """Initialize a Lutron connection."""
-        logger.info("Creating Lutron service (%s@%s:%s)", username, host, port)
-        super().__init__()
+class LutronReader:
+    """Frames the telnet byte stream into complete lines.
+
+    Reads into a reusable buffer, decodes incrementally (so multi-byte characters may be split
+    between reads), keeps partial lines until their terminator arrives and strips GNET/QNET prompts.
+    """
+    PROMPT = re.compile(r"^(?:[GQ]NET> ?)+")
+
+    def __init__(self, sock: socket.socket, buffer_size: int = 65536):
+        self.sock = sock
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._partial = ""
+        self.reads = 0
+
+    def read_lines(self) -> Optional[List[str]]:
+        """Block for the next chunk and return the complete lines in it, or None if the connection was closed."""
+        size = self.sock.recv_into(self._buffer)
+        if not size:
+            return None
+        self.reads += 1
+
+        *lines, self._partial = (self._partial + self._decoder.decode(self._view[:size])).split("\n")
+        # A bare prompt is not the start of a line - drop it so it doesn't prefix the next event
+        self._partial = self.PROMPT.sub("", self._partial)
+
+        return [line for line in (self.PROMPT.sub("", line.strip()) for line in lines) if line]
+
+
+class LutronWriter:
+    """Single writer thread for Lutron commands.
+
+    Commands queued for the same target (e.g. #OUTPUT,12,1) are merged so only the latest value is sent.
+    Queued commands are written in batches with sendall, paced to at most max_commands_per_second - a batch
+    holds no more commands than the rate allows since the previous write (and never more than a second's worth).
+    While the connection is down commands are held, and on reconnect the ones held disconnected for longer
+    than command_ttl are dropped. Time spent queued behind the pacing while connected never expires a command.
+    """
+
+    def __init__(self, connection: 'LutronConnection', max_commands_per_second: Optional[float] = None, command_ttl: float = 30, batch_size: int = 20):
+        self.connection = connection
+        self.interval = 1.0 / max_commands_per_second if max_commands_per_second else 0.0
+        self.command_ttl = command_ttl
+        self.batch_size = batch_size
+        self.running = False
+
+        # merge key -> (command, time queued)
+        self._pending: "OrderedDict[Any, Tuple[str, float]]" = OrderedDict()
+        self._condition = threading.Condition()
+        self._next_write = 0.0
+        self._last_write = 0.0
+        self._down_since: Optional[float] = time.monotonic()  # The connection starts out disconnected
+
+        self.merged = 0
+        self.sent = 0
+        self.expired = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self._pending)
+
+    def stats(self) -> Dict[str, int]:
+        return {"depth": self.depth, "merged": self.merged, "sent": self.sent, "expired": self.expired}
+
+    @staticmethod
+    def _merge_key(cmd: str) -> Any:
+        # "#OUTPUT,12,1,50.00" and "#OUTPUT,12,1,75.00" set the same thing - only the latest one matters
+        fields = cmd.split(",", 3)
+        if len(fields) == 4 and fields[0] in ("#OUTPUT", "#SYSVAR"):
+            return tuple(fields[:3])
+        if len(fields) == 3 and fields[0] in ("?OUTPUT", "?SYSVAR"):
+            return tuple(fields)
+        return object()  # Never merged (button presses, ...)
+
+    def put(self, cmd: str) -> None:
+        key = self._merge_key(cmd)
+        with self._condition:
+            if self._pending.pop(key, None) is not None:
+                self.merged += 1
+            self._pending[key] = (cmd, time.monotonic())
+            self._condition.notify()
+
+    def wake(self):
+        """Re-check the connection state (called on state transitions)."""
+        with self._condition:
+            now = time.monotonic()
+            if self.connection.state != CONNECTED:
+                if self._down_since is None:
+                    self._down_since = now
+            elif self._down_since is not None:
+                self._expire(now)
+                self._down_since = None
+            self._condition.notify()
+
+    def _expire(self, now: float):
+        # Drop the commands held for longer than command_ttl during the outage that just ended
+        for key, (cmd, queued) in list(self._pending.items()):
+            if now - max(queued, self._down_since) > self.command_ttl:
+                del self._pending[key]
+                self.expired += 1
+                logger.warning("Dropping stale Lutron command: %s", cmd)
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._write_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        with self._condition:
+            self.running = False
+            self._condition.notify()
+
+    def _batch_limit(self) -> int:
+        if not self.interval:
+            return self.batch_size
+        elapsed = min(time.monotonic() - self._last_write, 1.0)
+        return max(1, min(self.batch_size, int(elapsed / self.interval)))
+
+    def _take_batch(self) -> List[Tuple[Any, Tuple[str, float]]]:
+        batch = []
+        limit = self._batch_limit()
+        while self._pending and len(batch) < limit:
+            batch.append(self._pending.popitem(last=False))
+        return batch
+
+    def _requeue(self, batch):
+        # Put a failed batch back in front, unless a newer command for the same target was queued meanwhile
+        with self._condition:
+            for key, entry in reversed(batch):
+                if key not in self._pending:
+                    self._pending[key] = entry
+                    self._pending.move_to_end(key, last=False)
+
+    def _write_loop(self):
+        while self.running:
+            with self._condition:
+                while self.running and not (self._pending and self.connection.state == CONNECTED):
+                    self._condition.wait()
+                if not self.running:
+                    break
+
+            # Pace writes so the repeater is never flooded
+            delay = self._next_write - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+            with self._condition:
+                batch = self._take_batch()
+            if not batch:
+                continue
+
+            try:
+                self.connection._write("".join(f"{cmd}\r\n" for _, (cmd, _) in batch))
+                self.sent += len(batch)
+            except Exception as e:
+                logger.error("Failed to send %d Lutron commands, holding them until reconnected: %s", len(batch), e)
+                self._requeue(batch)
+            self._last_write = time.monotonic()
+            self._next_write = self._last_write + len(batch) * self.interval
+
+
+class LutronConnection:
+    """A single integration connection (main repeater / processor) of the Lutron service.
+
+    Owns the socket, the listener thread that (re)connects with backoff, and the command writer.
+    Received lines are handed back to the Lutron service, which holds the shared dispatch index.
+    """
+
+    def __init__(self, lutron: 'Lutron', host: str, port: int, username: str, password: str, max_commands_per_second: Optional[float] = None,
+                 connect_timeout: float = 10, login_timeout: float = 10, reconnect_delay: float = 1, max_reconnect_delay: float = 60, command_ttl: float = 30):
+        self.lutron = lutron
         self.host = host
         self.port = port
         self.username = username
         self.password = password
+        self.connect_timeout = connect_timeout
+        self.login_timeout = login_timeout
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
         self.sock: Optional[socket.socket] = None
-        
-        # Single list of all handlers
-        self._handlers: List[LutronConnector] = []
-        
+        self.reader: Optional[LutronReader] = None
+        self.writer = LutronWriter(self, max_commands_per_second, command_ttl)
+
+        # Connection state, also published as a connector so bindings can react to it
+        self.state = DISCONNECTED
+        self.health = Connector(name=f"Lutron<{host}>.health")
+        self.running = False
+        self._stopped = threading.Event()
+
+        # Keys still waiting for a reply to the state queries sent after login
+        self.bootstrap_pending = set()
 
     def start(self):
         logger.info(f"Starting Lutron listener for {self.username}@{self.host}:{self.port}")
-        # Connect and start listening
-        self.connect()
+        # Connecting happens on the listener thread so a dead repeater never blocks startup
+        self.writer.start()
         self._start_listener()
 
+    def _set_state(self, state: str):
+        if state == self.state:
+            return
+        logger.info("Lutron %s: %s -> %s", self.host, self.state, state)
+        self.state = state
+        self.health.set(state, act=False)
+        self.writer.wake()
+        self.lutron._update_health()
+
     def connect(self) -> bool:
         """Establish connection to the Lutron system."""
+        self._set_state(CONNECTING)
         try:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.connect((self.host, self.port))
-            self.sock.settimeout(60*10)  # 10 minutes timeout
+            self.sock = socket.create_connection((self.host, self.port), timeout=self.connect_timeout)
+            self.sock.settimeout(self.login_timeout)
             
             # Handle authentication
             self._read_prompt()  # Username prompt
-            self.send_command(self.username, secret=True)
+            self._write(f"{self.username}\r\n")
             self._read_prompt()  # Password prompt
-            self.send_command(self.password,secret=True)
+            self._write(f"{self.password}\r\n")
             self._read_prompt()  # Login success
+            self.sock.settimeout(60*10)  # 10 minutes timeout
+            self.reader = LutronReader(self.sock)
             
             # Enable monitoring for sysvars
-            self.send_command("#MONITORING,10,1")
+            self._write("#MONITORING,10,1\r\n")
+            self._set_state(CONNECTED)
+            self.lutron._bootstrap(self)
             return True
         except Exception as e:
-            logger.error("Failed to connect: %s", e)
+            logger.error("Failed to connect to %s: %s", self.host, e)
+            self._disconnect()
             return False
+
+    def _disconnect(self, sock: Optional[socket.socket] = None):
+        """Drop the connection (only if it is still `sock`, when given) - the listener thread reconnects."""
+        if sock is not None and sock is not self.sock:
+            return
+        if self.sock:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+        self._set_state(DISCONNECTED)
+
+    def _reconnect_delay(self, attempt: int) -> float:
+        # Exponential backoff with jitter so several services don't hammer the repeater in lockstep
+        return min(self.max_reconnect_delay, self.reconnect_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
     
     def _read_prompt(self) -> str:
         """Read and return server prompt."""
-        try:
-            data = self.sock.recv(1024).decode('utf-8')
-            if data:
-                logger.debug("Server prompt: %s", data.strip())
-        except Exception as e:
-            logger.error("Error reading prompt: %s", e)
+        data = self.sock.recv(1024).decode('utf-8', errors='replace')
+        if not data:
+            raise ConnectionError("Connection closed during login")
+        logger.debug("Server prompt: %s", data.strip())
+        return data
     
-    def send_command(self, cmd: str, secret = False) -> None:
-        """Send a command to the Lutron system."""
-        if not secret: logger.debug("Running command: %s", cmd)
-        if not self.sock:
+    def send_command(self, cmd: str) -> None:
+        """Queue a command (written by the writer thread, held while disconnected)."""
+        self.writer.put(cmd)
+
+    def _write(self, data: str) -> None:
+        sock = self.sock
+        if not sock:
             raise ConnectionError("Not connected to Lutron system")
-        self.sock.send(f"{cmd}\r\n".encode())
+        try:
+            sock.sendall(data.encode())
+        except OSError:
+            self._disconnect(sock)
+            raise
     
     def _start_listener(self):
         """Start the listener thread for processing events."""
         self.running = True
+        self._stopped.clear()
         self.thread = threading.Thread(target=self._listen_loop)
         self.thread.daemon = True
         self.thread.start()
     
     def _listen_loop(self):
-        """Main listening loop that processes incoming events."""
+        """Main listening loop that (re)connects and processes incoming events."""
+        attempts = 0  # Connection attempts since we last received data
         while self.running:
+            if self.state != CONNECTED:
+                if attempts:
+                    delay = self._reconnect_delay(attempts - 1)
+                    logger.warning("Reconnecting to Lutron %s in %.1fs", self.host, delay)
+                    if self._stopped.wait(delay):
+                        break
+                attempts += 1
+                self.connect()
+                continue
+
+            sock = self.sock
             try:
-                data = self.sock.recv(1024).decode('utf-8')
-                if not data:
+                lines = self.reader.read_lines()
+                if lines is None:
                     logger.warning("Connection closed by server. Reconnecting...")
-                    time.sleep(5)
-                    self.connect()
+                    self._disconnect(sock)
                     continue
+                attempts = 0
                 
-                for line in data.strip().split("\r\n"):
-                    self._process_event(line)
+                for line in lines:
+                    self.lutron._process_event(line, self)
                     
             except socket.timeout:
                 continue
             except Exception as e:
-                logger.error("Error in listen loop: %s", e)
-                time.sleep(5)
-                self.connect()
+                if self.running:
+                    logger.error("Error in listen loop: %s", e)
+                self._disconnect(sock)
+
+    def stop(self):
+        self.running = False
+        self._stopped.set()
+        self.writer.stop()
+        self._disconnect()
+
+
+class Lutron(Service):
+    # Event types whose current state can be queried with ?<TYPE>,<id>,<component>
+    QUERYABLE = ("OUTPUT", "SYSVAR")
+
+    def __init__(self, host: str = None, port: int = 23, username: str = None, password: str = None, repeaters: Optional[List[Dict[str, Any]]] = None,
+                 bootstrap_timeout: float = 10, **connection_options):
+        """
+        Initialize the Lutron service.
+
+        Args:
+            host, port, username, password: The main repeater / processor
+            repeaters: Optional list of additional connections. Each entry has host, and optionally port, username,
+                       password (defaulting to the service's) and ids - the integration IDs handled by that connection.
+                       IDs not listed are routed to the connection their events arrive on (the first one until then).
+            connection_options: max_commands_per_second, command_ttl, connect_timeout, login_timeout,
+                                reconnect_delay and max_reconnect_delay for all connections
+        """
+        super().__init__()
+        self.connections: List[LutronConnection] = []
+        # integration id -> connection handling it
+        self._routes: Dict[str, LutronConnection] = {}
+
+        entries = ([{"host": host, "port": port}] if host else []) + list(repeaters or [])
+        for entry in entries:
+            entry = dict(entry)
+            ids = entry.pop("ids", [])
+            config = {"port": port, "username": username, "password": password, **connection_options, **entry}
+            logger.info("Creating Lutron connection (%s@%s:%s)", config["username"], config["host"], config["port"])
+            connection = LutronConnection(self, **config)
+            self.connections.append(connection)
+            for integration_id in ids:
+                self._routes[str(integration_id)] = connection
+        if not self.connections:
+            raise ValueError("Lutron service needs a host or a list of repeaters")
+
+        # Aggregated state of all connections (degraded when they differ)
+        self.health = Connector(name="Lutron.health")
+        
+        # Handlers indexed by (command type, integration id, component), and handlers that want every line
+        self._handlers: Dict[EventKey, List[LutronConnector]] = {}
+        self._pattern_handlers: List[LutronConnector] = []
+
+        self.bootstrap_timeout = bootstrap_timeout
+
+    def start(self):
+        for connection in self.connections:
+            connection.start()
+
+    def _update_health(self):
+        states = {connection.state for connection in self.connections}
+        self.health.set(states.pop() if len(states) == 1 else "degraded", act=False)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {f"{connection.host}:{connection.port}": connection.writer.stats() for connection in self.connections}
+
+    def _route(self, integration_id: str) -> Optional[LutronConnection]:
+        return self._routes.get(integration_id) if len(self.connections) > 1 else self.connections[0]
+
+    def send_command(self, cmd: str) -> None:
+        """Queue a command on the connection handling its integration ID."""
+        logger.debug("Running command: %s", cmd)
+        fields = cmd.split(",", 2)
+        connection = self._route(fields[1]) if len(fields) > 1 else None
+        (connection or self.connections[0]).send_command(cmd)
     
     def register_handler(self, handler: LutronConnector):
         """Register a handler for Lutron events."""
-        self._handlers.append(handler)
+        if handler.key is not None:
+            self._handlers.setdefault(handler.key, []).append(handler)
+        else:
+            self._pattern_handlers.append(handler)
+
+    @staticmethod
+    def _parse_event(line: str) -> Tuple[Optional[EventKey], List[str]]:
+        """Split a monitoring line (e.g. ~OUTPUT,12,1,50.00) into its event key and remaining arguments."""
+        if not line.startswith("~"):
+            return None, []
+        fields = line[1:].split(",")
+        if len(fields) < 3:
+            return None, fields[1:]
+        return (fields[0], fields[1], fields[2]), fields[3:]
+
+    def _bootstrap(self, connection: LutronConnection):
+        """Query the state of every output and sysvar on this connection - replies arrive through the normal dispatch.
 
-    def _process_event(self, line: str):
-        """Process a single event line by passing it to all handlers."""
+        IDs that aren't routed yet are queried on every connection, and the reply teaches us the route.
+        """
+        connection.bootstrap_pending = {key for key in self._handlers if key[0] in self.QUERYABLE and self._route(key[1]) in (connection, None)}
+        if not connection.bootstrap_pending:
+            return
+        logger.info("Querying state of %d Lutron integration IDs on %s", len(connection.bootstrap_pending), connection.host)
+        for command, integration_id, component in list(connection.bootstrap_pending):
+            connection.send_command(f"?{command},{integration_id},{component}")
+
+        timer = threading.Timer(self.bootstrap_timeout, self._check_bootstrap, args=(connection,))
+        timer.daemon = True
+        timer.start()
+
+    def _check_bootstrap(self, connection: LutronConnection):
+        # Unrouted IDs were asked everywhere - only report the ones no connection answered
+        missing = sorted(key for key in connection.bootstrap_pending if self._route(key[1]) in (connection, None))
+        if missing:
+            logger.warning("No state reply from %s within %ss for: %s", connection.host, self.bootstrap_timeout, ", ".join(",".join(key) for key in missing))
+        else:
+            logger.info("Lutron state bootstrap completed on %s", connection.host)
+
+    def _process_event(self, line: str, connection: Optional[LutronConnection] = None):
+        """Process a single event line by passing it to the handlers registered for its key."""
         # logger.debug("Processing Line: %s", line)
+        key, args = self._parse_event(line)
+        if key and connection:
+            if connection.bootstrap_pending:
+                connection.bootstrap_pending.discard(key)
+            # Learn which connection handles this integration ID
+            if key[1] not in self._routes:
+                self._routes[key[1]] = connection
 
-        # Pass the event to all handlers - they'll decide if they want to handle it
-        had_positive_handler = False
-        if any([handler.safely_process_event(line) is not None for handler in self._handlers]):
+        # Indexed handlers only see their own events, pattern handlers see everything
+        processed = False
+        for handler in self._handlers.get(key, ()):
+            processed |= handler.safely_process_event(line, args) is not None
+        for handler in self._pattern_handlers:
+            processed |= handler.safely_process_event(line, args) is not None
+
+        if processed:
             logger.debug("Processed Line: %s", line)
             return True
     
@@ -250,7 +621,6 @@ class Lutron(Service):
         return LutronPattern(self, pattern)
 
     def stop(self):
-        """Stop the listener and clean up resources."""
-        self.running = False
-        if self.sock:
-            self.sock.close()
+        """Stop the listeners and clean up resources."""
+        for connection in self.connections:
+            connection.stop()
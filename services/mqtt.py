@@ -2,14 +2,15 @@
 
 from .connector import Connector
 from .service import Service
-import subprocess
+from .mqtt_client import MQTTClient, TopicTrie, filter_covers, plan_subscriptions
 import re
-from typing import Any
+from collections import OrderedDict
+from typing import Any, Callable
 from dataclasses import dataclass
 from logger import get_logger
-from shell_listener import ShellListener
 import json
 import threading
+import time
 
 logger = get_logger(__name__)
 
@@ -37,20 +38,25 @@ class MQTTDevice(Connector):
         self.protocol = protocol
         self.retain = retain
         
+        # State payload -> index in the protocol's states
+        self._states = {str(state): index for index, state in enumerate(self.protocol['states'])}
+
         # Register the listener for state updates
-        self.mqtt.topics.add(topic)
-        self.listener = self.mqtt.listener.filter(f"{self.topic}{self.protocol['state_suffix']} ({'|'.join(map(str,self.protocol['states'])) if self.protocol['states'] else '.*'})")
-        self.listener.register(self._on_state_update)
+        self.mqtt.subscribe(f"{self.topic}{self.protocol['state_suffix']}", self._on_state_update)
+
+    def close(self):
+        """Stop receiving state updates for this device."""
+        self.mqtt.unsubscribe(f"{self.topic}{self.protocol['state_suffix']}", self._on_state_update)
         
-    def _on_state_update(self, line: str, match: str):
+    def _on_state_update(self, topic: str, message: str):
         """Handle state updates from MQTT"""
-        try:
-            logger.debug("on_state_update %s %s", line, match)
-            index = self.protocol['states'].index(match) if self.protocol['states'] else match
+        logger.debug("on_state_update %s %s", topic, message)
+        if not self._states:
+            self.set(message, act=False)
+        elif (index := self._states.get(message)) is not None:
             self.set(index, act=False)
-        except ValueError:
-            logger.warning("Unrecognized state '%s' for device %s", match, self.topic)
-            self.set(match, act=False)
+        else:
+            logger.debug("Ignoring unrecognized state '%s' for device %s", message, self.topic)
             
     
     def _set_action(self, value: Any) -> None:
@@ -64,13 +70,15 @@ class MQTTDevice(Connector):
 
 
 class UserPresense:
-    def __init__(self, mqtt, name, inside_room, outside_room, outside_reset_time=None, outside_distance=None):
+    def __init__(self, mqtt, name, inside_room, outside_room, outside_reset_time=None, outside_distance=None, min_interval=0):
         self.mqtt = mqtt
         self.name = name
         self.inside_room = inside_room
         self.outside_room = outside_room
         self.outside_reset_time = outside_reset_time
         self.outside_distance = outside_distance
+        self.min_interval = min_interval
+        self._last_message = {}  # room -> time of the last message we processed
 
         bool_protocol = {"state_suffix": "", "command_suffix": "", "states": ["false","true"], "commands": ["false", "true"]}
         self.inside = MQTTDevice(mqtt=mqtt, topic=f"presense/{name}/inside", protocol=bool_protocol, retain=True)
@@ -79,21 +87,34 @@ class UserPresense:
         self.timer = None
 
     def parse_esp32_message(self, room, message):
+        # Devices advertise several times a second - ignore messages arriving faster than min_interval
+        if self.min_interval:
+            now = time.monotonic()
+            if now - self._last_message.get(room, float("-inf")) < self.min_interval:
+                return
+            self._last_message[room] = now
+
         if room == self.inside_room:
             self.inside.set(True)
         elif room == self.outside_room:
-            message = json.loads(message)
             # If not home, than we are definitely outside
             if not self.inside.get(): 
                 self.outside.set(True)
                 
-            # If we are home, then we are outside only if we are close to the outside sensor
-            elif self.outside_distance is None or message["distance"] < self.outside_distance:
+            # If we are home, then we are outside only if we are close to the outside sensor (the only case that needs the distance)
+            elif self.outside_distance is None or json.loads(message)["distance"] < self.outside_distance:
                 self.inside.set(False)
                 self.outside.set(True)    
 
             self.reset_outside_timer()
 
+    def close(self):
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        self.inside.close()
+        self.outside.close()
+
     def reset_outside_timer(self):
         if self.timer:
             self.timer.cancel()
@@ -105,20 +126,29 @@ class UserPresense:
 
 
 class ESPresense(Service):
-    def __init__(self, service: 'MQTT', inside_room, outside_room, outside_reset_time=3, outside_distance=4):
+    def __init__(self, service: 'MQTT', inside_room, outside_room, outside_reset_time=3, outside_distance=4, min_interval=0, sensor_ttl=3600, max_sensors=256):
         logger.info(f"Creating ESPresense (Inside room: {inside_room}, Outside room: {outside_room})")
         self.mqtt = service
         self.inside_room = inside_room
         self.outside_room = outside_room
         self.outside_reset_time = outside_reset_time
         self.outside_distance = outside_distance
+        self.min_interval = min_interval
 
         self.sensors = {}
+        # Names of the sensors currently inside / outside, so "anybody" is updated in O(1)
+        self._inside = set()
+        self._outside = set()
+
+        # Sensors created on the fly (not declared in config) by last time seen - evicted when idle or over the cap
+        self.sensor_ttl = sensor_ttl
+        self.max_sensors = max_sensors
+        self._discovered = OrderedDict()
+        self.evicted = 0
         
-        # Register the listener for state updates
-        self.mqtt.topics.add(f"espresense/devices")
-        self.listener = self.mqtt.listener.filter(f"espresense/devices/(?P<name>[^/]*)/(?P<room>{inside_room}{f'|{outside_room}' if outside_room else ''}) (?P<message>.*)", log=False)
-        self.listener.register(self._on_esp32_update)
+        # Register the listener for state updates - only the configured rooms are subscribed at the broker
+        for room in filter(None, (inside_room, outside_room)):
+            self.mqtt.subscribe(f"espresense/devices/+/{room}", self._on_esp32_update)
 
         self.anybody = UserPresense(self.mqtt, "anybody", self.inside_room, self.outside_room)
         
@@ -127,49 +157,120 @@ class ESPresense(Service):
 
     def device(self,name):
         return self._get_sensor(name)
+
+    @property
+    def live_sensors(self) -> int:
+        return len(self.sensors)
         
-    def _get_sensor(self,name):
+    def _get_sensor(self,name, declared=True):
+        if declared:
+            self._discovered.pop(name, None)
+        elif name in self._discovered or name not in self.sensors:
+            self._discovered[name] = time.monotonic()
+            self._discovered.move_to_end(name)
+
         if name not in self.sensors:
-            self.sensors[name]  = UserPresense(self.mqtt, name, self.inside_room, self.outside_room, self.outside_reset_time, self.outside_distance)
-            self.sensors[name].inside.on_set(self.update_anybody_sensor)
-            self.sensors[name].outside.on_set(self.update_anybody_sensor)
+            self.sensors[name]  = UserPresense(self.mqtt, name, self.inside_room, self.outside_room, self.outside_reset_time, self.outside_distance, self.min_interval)
+            self.sensors[name].inside.on_set(lambda value, name=name: self.update_anybody_sensor(self._inside, self.anybody.inside, name, value))
+            self.sensors[name].outside.on_set(lambda value, name=name: self.update_anybody_sensor(self._outside, self.anybody.outside, name, value))
 
         return self.sensors[name]
         
-    def update_anybody_sensor(self, value):
-        self.anybody.outside.set(any(sensor.outside.get() for sensor in self.sensors.values()))
-        self.anybody.inside.set(any(sensor.inside.get() for sensor in self.sensors.values()))
+    def _evict_sensors(self):
+        expired_before = time.monotonic() - self.sensor_ttl if self.sensor_ttl else None
+        while self._discovered:
+            name, last_seen = next(iter(self._discovered.items()))
+            if not ((self.max_sensors and len(self._discovered) > self.max_sensors) or (expired_before and last_seen < expired_before)):
+                break
+            del self._discovered[name]
+            self.sensors.pop(name).close()
+            self.update_anybody_sensor(self._inside, self.anybody.inside, name, False)
+            self.update_anybody_sensor(self._outside, self.anybody.outside, name, False)
+            self.evicted += 1
+            logger.debug("Evicted espresense sensor %s (%d live, %d evicted)", name, self.live_sensors, self.evicted)
+
+    def update_anybody_sensor(self, present: set, anybody: MQTTDevice, name, value):
+        if value:
+            present.add(name)
+        else:
+            present.discard(name)
+        anybody.set(bool(present))
         
-    def _on_esp32_update(self, line: str, match: dict):
-        """Handle espresenses state updates received from MQTT"""
+    def _on_esp32_update(self, topic: str, message: str):
+        """Handle espresenses state updates received from MQTT (espresense/devices/<name>/<room>)"""
+        _, _, name, room = topic.split("/")
         try:
-            sensor = self._get_sensor(match["name"])
-            sensor.parse_esp32_message(match["room"], match["message"])
+            sensor = self._get_sensor(name, declared=False)
+            self._evict_sensors()
+            sensor.parse_esp32_message(room, message)
         except ValueError:
-            logger.warning("Problematic espresense line: '%s' (Match: %s)", line, match)
+            logger.warning("Problematic espresense message: '%s' (Topic: %s)", message, topic)
 
 
 class MQTT(Service):
-    def __init__(self, host: str, username: str, password: str, protocols = mqtt_protocols):
+    def __init__(self, host: str, username: str, password: str, protocols = mqtt_protocols, port: int = 1883, keepalive: int = 60, qos: int = 0):
         super().__init__()
         logger.info("Creating MQTT service (%s@%s)", username, host)
         self.host = host
         self.username = username
         self.password = password
         self.protocols = protocols
-        self.topics = set()
-        # Create the listener for state updates
-        self.listener = ShellListener(f"")
+        self.qos = qos
+        # Incoming messages are routed by topic to the callbacks subscribed to them
+        self.subscribers = TopicTrie()
+        self._subscriptions_lock = threading.Lock()
+        self.started = False
+        # One persistent connection for both subscribing and publishing
+        self.client = MQTTClient(host, port, username, password, keepalive=keepalive, on_message=self._on_message)
         
     def start(self):
-        # Create the listener for state updates
-        if self.topics:
-            self.listener.shell_command = f"mosquitto_sub -h {self.host} -u {self.username} -P {self.password} -t {('/# -t '.join(self.topics)+'/#') if self.topics else '#'} -v"
-            #logger.info(self.listener.shell_command)
-            logger.info(f"Starting MQTT listener for {self.username}@{self.host} with topics: {', '.join(self.topics) if self.topics else '#'}")
-            self.listener.start()
+        # Subscribe before connecting, so the subscriptions are sent as part of the connection setup
+        with self._subscriptions_lock:
+            self.started = True
+            plan = plan_subscriptions(self.subscribers.filters())
+            self.client.subscribe(sorted(plan))
+        if plan:
+            logger.info(f"Starting MQTT listener for {self.username}@{self.host} with topics: {', '.join(sorted(plan))}")
         else:
-            logger.error("No devices/topics found so no need to start MQTT service")
+            logger.warning("No devices/topics found - MQTT will only be used for publishing")
+        self.client.start()
+
+    def subscribe(self, topic_filter: str, callback: Callable[[str, str], Any]):
+        """Call callback(topic, message) for every message on topics matching topic_filter (+ and # wildcards allowed)."""
+        with self._subscriptions_lock:
+            self.subscribers.add(topic_filter, callback)
+            if not self.started:
+                return  # Planned once on start
+            # Nothing to do if an existing subscription already covers it, otherwise it replaces the ones it covers
+            current = self.client.subscriptions
+            if not any(filter_covers(subscription, topic_filter) for subscription in current):
+                covered = [subscription for subscription in current if filter_covers(topic_filter, subscription)]
+                self.client.subscribe([topic_filter])
+                self.client.unsubscribe(covered)
+
+    def unsubscribe(self, topic_filter: str, callback: Callable[[str, str], Any]):
+        with self._subscriptions_lock:
+            if not self.subscribers.remove(topic_filter, callback) or not self.started:
+                return
+            if topic_filter not in self.client.subscriptions:
+                return  # Covered by another subscription
+            # Re-plan only the filters this subscription was covering
+            covered = [remaining for remaining in self.subscribers.filters() if filter_covers(topic_filter, remaining)]
+            others = self.client.subscriptions - {topic_filter}
+            replacements = [replacement for replacement in plan_subscriptions(covered) if not any(filter_covers(other, replacement) for other in others)]
+            self.client.subscribe(sorted(replacements))
+            self.client.unsubscribe([topic_filter])
+
+    def _on_message(self, topic: str, payload: bytes):
+        callbacks = self.subscribers.match(topic)
+        if not callbacks:
+            return
+        message = payload.decode("utf-8", errors="replace").strip()
+        for callback in callbacks:
+            try:
+                callback(topic, message)
+            except Exception as e:
+                logger.exception("Error handling MQTT message on %s: %s", topic, e)
     
 
     def device(self, topic: str, protocol: str = None, process_same_value_events = None) -> MQTTDevice:
@@ -178,9 +279,8 @@ class MQTT(Service):
         
     def send(self, topic: str, message: str, retain = False):
         logger.debug("Sending MQTT command: topic=%s message=%s", topic, message)
-        cmd = f'mosquitto_pub -h {self.host} -u {self.username} -P {self.password} -t "{topic}" -m "{message}" {"-r" if retain else ""}'
-        subprocess.run(cmd, shell=True, check=True, capture_output=True, text=True)
+        self.client.publish(topic, message, qos=self.qos, retain=retain)
     
     def stop(self):
-        logger.info("Stopping MQTT Listener")
-        self.listener.stop()
+        logger.info("Stopping MQTT client")
+        self.client.stop()
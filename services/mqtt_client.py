@@ -0,0 +1,416 @@
+#!/usr/bin/python3
+
+import os
+import random
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from logger import get_logger
+
+logger = get_logger(__name__)
+
+# MQTT 3.1.1 control packet types (upper nibble of the fixed header)
+CONNECT, CONNACK, PUBLISH, PUBACK = 0x10, 0x20, 0x30, 0x40
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 0x80, 0x90, 0xA0, 0xB0
+PINGREQ, PINGRESP, DISCONNECT = 0xC0, 0xD0, 0xE0
+
+CONNACK_ERRORS = {1: "unacceptable protocol version", 2: "identifier rejected", 3: "server unavailable",
+                  4: "bad username or password", 5: "not authorized"}
+
+
+def _encode_length(length: int) -> bytes:
+    out = bytearray()
+    while True:
+        length, digit = divmod(length, 128)
+        out.append(digit | (0x80 if length else 0))
+        if not length:
+            return bytes(out)
+
+
+def _encode_string(value) -> bytes:
+    data = value if isinstance(value, bytes) else str(value).encode()
+    return struct.pack("!H", len(data)) + data
+
+
+def _packet(header: int, body: bytes = b"") -> bytes:
+    return bytes([header]) + _encode_length(len(body)) + body
+
+
+class MQTTClient:
+    """
+    Minimal MQTT 3.1.1 client - a single persistent connection used for both subscribing and publishing.
+
+    A reader thread (re)connects with backoff, keeps the connection alive and hands incoming messages to
+    on_message(topic, payload). Outbound packets are queued and written in batches by a writer thread, so
+    publishing never blocks the caller. QoS 1 publishes are resent on reconnect until acknowledged.
+    """
+
+    def __init__(self, host: str, port: int = 1883, username: Optional[str] = None, password: Optional[str] = None,
+                 client_id: Optional[str] = None, keepalive: int = 60, on_message: Optional[Callable[[str, bytes], None]] = None,
+                 reconnect_delay: float = 1, max_reconnect_delay: float = 60, max_queued: int = 10000):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.client_id = client_id or f"connector-{os.getpid()}-{random.randrange(1 << 16):04x}"
+        self.keepalive = keepalive
+        self.on_message = on_message
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+
+        self.sock: Optional[socket.socket] = None
+        self._buffer = bytearray()
+        self.connected = False
+        self.running = False
+        self._stopped = threading.Event()
+
+        self.subscriptions: Set[str] = set()
+        self._outbound = deque(maxlen=max_queued)
+        self._condition = threading.Condition()
+        self._inflight: Dict[int, bytes] = {}  # Unacknowledged QoS 1 publishes by packet id
+        self._next_packet_id = 0
+        self._last_sent = 0.0
+        self._last_received = 0.0
+
+        self.published = 0
+        self.received = 0
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self._stopped.clear()
+        for target in (self._read_loop, self._write_loop):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        self.running = False
+        self._stopped.set()
+        if self.connected:
+            try:
+                self.sock.sendall(_packet(DISCONNECT))
+            except OSError:
+                pass
+        self._disconnect()
+
+    def _packet_id(self) -> int:
+        with self._condition:
+            self._next_packet_id = self._next_packet_id % 0xFFFF + 1
+            return self._next_packet_id
+
+    def _queue(self, data: bytes):
+        with self._condition:
+            self._outbound.append(data)
+            self._condition.notify()
+
+    def publish(self, topic: str, payload, qos: int = 0, retain: bool = False):
+        """Queue a publish. Never blocks - messages published while disconnected are sent after reconnecting."""
+        data = payload if isinstance(payload, bytes) else str(payload).encode()
+        body = _encode_string(topic)
+        if qos:
+            packet_id = self._packet_id()
+            body += struct.pack("!H", packet_id)
+        packet = _packet(PUBLISH | (qos << 1) | (1 if retain else 0), body + data)
+        if qos:
+            self._inflight[packet_id] = packet
+        self._queue(packet)
+        self.published += 1
+
+    def subscribe(self, topics: Iterable[str], qos: int = 0):
+        topics = [topic for topic in topics if topic not in self.subscriptions]
+        if not topics:
+            return
+        self.subscriptions.update(topics)
+        if self.connected:
+            self._queue(self._subscribe_packet(topics, qos))
+
+    def unsubscribe(self, topics: Iterable[str]):
+        topics = [topic for topic in topics if topic in self.subscriptions]
+        if not topics:
+            return
+        self.subscriptions.difference_update(topics)
+        if self.connected:
+            body = struct.pack("!H", self._packet_id()) + b"".join(_encode_string(topic) for topic in topics)
+            self._queue(_packet(UNSUBSCRIBE | 0x02, body))
+
+    def _subscribe_packet(self, topics: List[str], qos: int = 0) -> bytes:
+        body = struct.pack("!H", self._packet_id()) + b"".join(_encode_string(topic) + bytes([qos]) for topic in topics)
+        return _packet(SUBSCRIBE | 0x02, body)
+
+    def _connect(self):
+        flags = 0x02  # Clean session
+        payload = _encode_string(self.client_id)
+        if self.username is not None:
+            flags |= 0x80
+            payload += _encode_string(self.username)
+        if self.password is not None:
+            flags |= 0x40
+            payload += _encode_string(self.password)
+
+        sock = socket.create_connection((self.host, self.port), timeout=10)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.sendall(_packet(CONNECT, _encode_string("MQTT") + bytes([4, flags]) + struct.pack("!H", self.keepalive) + payload))
+
+        self.sock = sock
+        self._buffer = bytearray()
+        packet_type, body = self._read_packet()
+        if packet_type != CONNACK or len(body) < 2:
+            raise ConnectionError(f"Unexpected packet {packet_type:#x} while waiting for CONNACK")
+        if body[1]:
+            raise ConnectionError(f"Connection refused: {CONNACK_ERRORS.get(body[1], body[1])}")
+
+        # Subscriptions and unacknowledged publishes go out before anything queued while we were down
+        initial = []
+        if self.subscriptions:
+            initial.append(self._subscribe_packet(sorted(self.subscriptions)))
+        with self._condition:
+            queued = set(self._outbound)
+        initial += [bytes([packet[0] | 0x08]) + packet[1:] for packet in list(self._inflight.values()) if packet not in queued]  # DUP flag
+        if initial:
+            sock.sendall(b"".join(initial))
+
+        sock.settimeout(max(1, self.keepalive / 2))
+        self._last_sent = self._last_received = time.monotonic()
+        with self._condition:
+            self.connected = True
+            self._condition.notify()
+        logger.info("Connected to MQTT broker %s:%s", self.host, self.port)
+
+    def _disconnect(self, sock: Optional[socket.socket] = None):
+        if sock is not None and sock is not self.sock:
+            return
+        with self._condition:
+            was_connected = self.connected
+            self.connected = False
+        if self.sock:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+        if was_connected:
+            logger.warning("Disconnected from MQTT broker %s:%s", self.host, self.port)
+
+    def _read_packet(self) -> Tuple[int, bytes]:
+        """Read one complete packet - returns (packet type with flags, body)."""
+        while True:
+            packet = self._parse_packet()
+            if packet:
+                return packet
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionError("Connection closed by broker")
+            self._buffer += data
+
+    def _parse_packet(self) -> Optional[Tuple[int, bytes]]:
+        buffer = self._buffer
+        length, multiplier, position = 0, 1, 1
+        while True:
+            if position >= len(buffer):
+                return None
+            digit = buffer[position]
+            length += (digit & 0x7F) * multiplier
+            multiplier *= 128
+            position += 1
+            if not digit & 0x80:
+                break
+        if len(buffer) < position + length:
+            return None
+        header, body = buffer[0], bytes(buffer[position:position + length])
+        del buffer[:position + length]
+        return header, body
+
+    def _read_loop(self):
+        attempts = 0
+        while self.running:
+            if not self.connected:
+                if attempts:
+                    delay = min(self.max_reconnect_delay, self.reconnect_delay * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+                    logger.warning("Reconnecting to MQTT broker in %.1fs", delay)
+                    if self._stopped.wait(delay):
+                        break
+                attempts += 1
+                try:
+                    self._connect()
+                except Exception as e:
+                    logger.error("Failed to connect to MQTT broker %s:%s: %s", self.host, self.port, e)
+                    self._disconnect()
+                continue
+
+            sock = self.sock
+            try:
+                header, body = self._read_packet()
+                self._last_received = time.monotonic()
+                attempts = 0
+                self._handle_packet(header, body)
+            except socket.timeout:
+                self._check_keepalive(sock)
+            except Exception as e:
+                if self.running:
+                    logger.error("MQTT connection error: %s", e)
+                self._disconnect(sock)
+
+    def _check_keepalive(self, sock: socket.socket):
+        # PINGREQs are sent by the writer (see _write_loop) - here we only notice a silent broker.
+        # A keepalive of 0 turns the mechanism off, and the broker may then legitimately stay silent.
+        if self.keepalive and time.monotonic() - self._last_received > self.keepalive * 1.5:
+            logger.warning("No response from MQTT broker within keepalive")
+            self._disconnect(sock)
+
+    def _handle_packet(self, header: int, body: bytes):
+        packet_type = header & 0xF0
+        if packet_type == PUBLISH:
+            qos = (header >> 1) & 0x03
+            topic_length = struct.unpack_from("!H", body)[0]
+            topic = body[2:2 + topic_length].decode("utf-8", errors="replace")
+            position = 2 + topic_length
+            if qos:
+                packet_id = body[position:position + 2]
+                position += 2
+                self._queue(_packet(PUBACK, packet_id))
+            self.received += 1
+            if self.on_message:
+                try:
+                    self.on_message(topic, body[position:])
+                except Exception as e:
+                    logger.exception("Error handling MQTT message on %s: %s", topic, e)
+        elif packet_type == PUBACK:
+            self._inflight.pop(struct.unpack("!H", body[:2])[0], None)
+        elif packet_type == SUBACK and b"\x80" in body[2:]:
+            logger.error("MQTT broker rejected a subscription")
+
+    def _ping_due(self) -> Optional[float]:
+        """Seconds until a PINGREQ is due (<= 0 if it is), or None if no keepalive is needed."""
+        if not (self.connected and self.keepalive):
+            return None
+        return self._last_sent + self.keepalive / 2 - time.monotonic()
+
+    def _write_loop(self):
+        while self.running:
+            with self._condition:
+                # The keepalive is about what *we* send - inbound traffic doesn't count, so a busy
+                # subscription alone must not stop us from pinging
+                while self.running and not (self._outbound and self.connected):
+                    due = self._ping_due()
+                    if due is not None and due <= 0:
+                        self._outbound.append(_packet(PINGREQ))
+                        break
+                    self._condition.wait(due)
+                if not self.running:
+                    break
+                batch = list(self._outbound)
+                self._outbound.clear()
+                sock = self.sock
+
+            try:
+                sock.sendall(b"".join(batch))
+                self._last_sent = time.monotonic()
+            except Exception as e:
+                logger.error("Failed to write to MQTT broker: %s", e)
+                # Keep what we failed to send (QoS 1 publishes are resent from the inflight list anyway)
+                with self._condition:
+                    self._outbound.extendleft(reversed(batch))
+                self._disconnect(sock)
+
+
+def filter_covers(general: str, specific: str) -> bool:
+    """True if every topic matched by the `specific` filter is also matched by the `general` one."""
+    general_levels, specific_levels = general.split("/"), specific.split("/")
+    for index, level in enumerate(general_levels):
+        if level == "#":
+            return True
+        if index >= len(specific_levels) or specific_levels[index] == "#":
+            return False
+        if level != "+" and level != specific_levels[index]:
+            return False
+    return len(general_levels) == len(specific_levels)
+
+
+def plan_subscriptions(filters: Iterable[str]) -> Set[str]:
+    """The minimal set of subscriptions covering all filters - drops every filter covered by another one."""
+    filters = set(filters)
+    return {topic_filter for topic_filter in filters
+            if not any(other != topic_filter and filter_covers(other, topic_filter) for other in filters)}
+
+
+class _TopicNode:
+    __slots__ = ("children", "callbacks")
+
+    def __init__(self):
+        self.children: Dict[str, "_TopicNode"] = {}
+        self.callbacks: List[Callable] = []
+
+
+class TopicTrie:
+    """
+    Callbacks indexed by MQTT topic filter (supporting + and # wildcards).
+
+    A topic is split once and only the branches matching its levels are visited, so matching
+    costs O(topic depth) regardless of how many filters are registered.
+    """
+
+    def __init__(self):
+        self._root = _TopicNode()
+
+    def add(self, topic_filter: str, callback: Callable):
+        node = self._root
+        for level in topic_filter.split("/"):
+            node = node.children.setdefault(level, _TopicNode())
+        node.callbacks.append(callback)
+
+    def remove(self, topic_filter: str, callback: Callable) -> bool:
+        """Remove a callback - returns True if no callbacks are left for this filter."""
+        path = [self._root]
+        levels = topic_filter.split("/")
+        for level in levels:
+            node = path[-1].children.get(level)
+            if node is None:
+                return True
+            path.append(node)
+        if callback in path[-1].callbacks:
+            path[-1].callbacks.remove(callback)
+        empty = not path[-1].callbacks
+        # Prune branches that no longer lead anywhere
+        for level, node, parent in zip(reversed(levels), reversed(path[1:]), reversed(path[:-1])):
+            if node.callbacks or node.children:
+                break
+            del parent.children[level]
+        return empty
+
+    def match(self, topic: str) -> List[Callable]:
+        levels = topic.split("/")
+        depth = len(levels)
+        matched = []
+        stack = [(self._root, 0)]
+        while stack:
+            node, index = stack.pop()
+            children = node.children
+            if "#" in children:  # "a/#" also matches "a"
+                matched += children["#"].callbacks
+            if index == depth:
+                matched += node.callbacks
+                continue
+            child = children.get(levels[index])
+            if child is not None:
+                stack.append((child, index + 1))
+            child = children.get("+")
+            if child is not None:
+                stack.append((child, index + 1))
+        return matched
+
+    def filters(self) -> List[str]:
+        """All topic filters that currently have callbacks."""
+        result = []
+        stack = [(self._root, [])]
+        while stack:
+            node, path = stack.pop()
+            if node.callbacks and path:
+                result.append("/".join(path))
+            stack += [(child, path + [level]) for level, child in node.children.items()]
+        return result
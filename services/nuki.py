@@ -1,15 +1,249 @@
 #!/usr/bin/python3
 
-import subprocess
 from .connector import Connector
 from .service import Service
-from shell_listener import ShellListener
+from .executor import CoalescingExecutor, json_request
 
 from logger import get_logger
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import requests
+from requests.adapters import HTTPAdapter
+import socket
 import threading
+import time
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
 
 logger = get_logger(__name__)
 
+# Lock actions and states of the Nuki API
+UNLOCK, LOCK = 1, 2
+LOCKED, UNLOCKED, UNLATCHED = 1, 3, 5
+
+# The bridge answers /lockAction only once the lock has finished moving, which can take this long
+LOCK_ACTION_TIMEOUT = 30
+
+
+class NukiWebClient:
+    """
+    Client for the Nuki Web API (api.nuki.io).
+
+    The smartlock (state and advanced config) is cached for `cache_ttl` seconds and updated in place after
+    our own writes, so toggling autolock doesn't GET the lock again or rewrite a config that already has
+    the wanted value.
+    """
+
+    BASE_URL = "https://api.nuki.io"
+
+    def __init__(self, api_key: str, cache_ttl: float = 10, max_concurrency: int = 2, timeout: float = 10, retries: int = 2):
+        self.cache_ttl = cache_ttl
+        self.timeout = timeout
+        self.retries = retries
+
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Bearer {api_key}"
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency))
+        self.executor = CoalescingExecutor(max_concurrency, name="nuki")
+
+        self._cache: Dict[str, Tuple[float, Dict[str, Any]]] = {}  # str(nuki_id) -> (fetch time, smartlock) - config ids may be ints or strings
+        self.requests = 0
+        self.cache_hits = 0
+
+    def request(self, method: str, path: str, body: Optional[Dict[str, Any]] = None) -> Any:
+        """Send a request synchronously and return the decoded JSON body."""
+        self.requests += 1
+        return json_request(self.session, method, self.BASE_URL + path, body, self.timeout, self.retries)
+
+    def smartlock(self, nuki_id: str) -> Dict[str, Any]:
+        cached = self._cache.get(str(nuki_id))
+        if cached and time.monotonic() - cached[0] < self.cache_ttl:
+            self.cache_hits += 1
+            return cached[1]
+        smartlock = self.request("GET", f"/smartlock/{nuki_id}")
+        self._cache[str(nuki_id)] = (time.monotonic(), smartlock)
+        return smartlock
+
+    def invalidate(self, nuki_id: str):
+        self._cache.pop(str(nuki_id), None)
+
+    def lock_action(self, nuki_id: str, action: int):
+        """Send a lock action (1 - unlock, 2 - lock)."""
+        self.request("POST", f"/smartlock/{nuki_id}/action", {"action": action})
+        self.record_action(nuki_id, action)
+
+    def record_action(self, nuki_id: str, action: int):
+        """Record the lock state expected after a lock action (sent by any path) in the cache."""
+        cached = self._cache.get(str(nuki_id))
+        if cached:
+            cached[1].setdefault("state", {})["state"] = LOCKED if action == LOCK else UNLOCKED
+
+    def record_state(self, device_type: int, local_id: int, state: int):
+        """Record a lock state reported by a bridge in the cache."""
+        cached = self._cache.get(str(device_type << 32 | local_id))
+        if cached:
+            cached[1].setdefault("state", {})["state"] = state
+
+    def set_autolock(self, nuki_id: str, enabled: bool) -> Optional[int]:
+        """
+        Set the autolock flag of the advanced config.
+
+        Returns the lock action that brings the door in line - lock when enabling, unlock when
+        disabling - or None if it already is.
+        """
+        smartlock = self.smartlock(nuki_id)
+        config = smartlock.get("advancedConfig", {})
+        if config.get("autoLock") != enabled:
+            config = {key: value for key, value in config.items() if key != "operationId"}
+            config["autoLock"] = enabled
+            try:
+                self.request("POST", f"/smartlock/{nuki_id}/advanced/config", config)
+            except requests.RequestException:
+                self.invalidate(nuki_id)
+                raise
+            smartlock["advancedConfig"] = config
+        else:
+            logger.debug("Autolock of %s is already %s", nuki_id, enabled)
+
+        locked = smartlock.get("state", {}).get("state") == LOCKED
+        if enabled and not locked:
+            return LOCK
+        if not enabled and locked:
+            return UNLOCK
+        return None
+
+    def submit(self, key: Hashable, job: Callable[[], None]):
+        """Run job on the worker pool. A job still waiting for an earlier one with the same key is replaced."""
+        def run():
+            try:
+                job()
+            except requests.RequestException as e:
+                logger.error("Nuki request failed: %s", e)
+        self.executor.submit(key, run)
+
+    def close(self):
+        self.executor.shutdown()
+        self.session.close()
+
+
+class NukiBridgeClient:
+    """
+    Client for the HTTP API of a Nuki bridge on the LAN (port 8080, token auth).
+
+    Lock actions through the bridge take a few hundred milliseconds, against seconds through the cloud.
+    """
+
+    def __init__(self, ip: str, token: str, port: int = 8080, timeout: float = 3):
+        self.base_url = f"http://{ip}:{port}"
+        self.ip = ip
+        self.token = token
+        self.timeout = timeout
+        self.session = requests.Session()  # Keep-alive, the bridge serves one request at a time
+        self.callback_registered = False
+        self.callback_failures = 0
+
+    def request(self, path: str, timeout=None, **params) -> Any:
+        response = self.session.get(self.base_url + path, params={**params, "token": self.token}, timeout=timeout or self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def list(self) -> List[Dict[str, Any]]:
+        """The locks paired with the bridge"""
+        return self.request("/list")
+
+    def register_callback(self, url: str):
+        """Make the bridge POST lock state changes to url (unless it already does)"""
+        callbacks = self.request("/callback/list").get("callbacks", [])
+        if any(callback.get("url") == url for callback in callbacks):
+            return
+        result = self.request("/callback/add", url=url)
+        if not result.get("success"):
+            raise requests.RequestException(f"bridge {self.ip} refused callback {url}: {result.get('message', result)}")
+
+    def local_address(self) -> str:
+        """The address of this host on the interface that reaches the bridge"""
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.connect((self.ip, 8080))  # No packet is sent, this only picks the route
+            return sock.getsockname()[0]
+
+    def lock_action(self, nuki_id: str, action: int):
+        """
+        Send a lock action to the lock with the given Web API id. Raises if the bridge fails to perform it.
+
+        `timeout` only bounds connecting to the bridge - the response is waited for a full lock cycle.
+        """
+        device_type, local_id = split_smartlock_id(nuki_id)
+        result = self.request("/lockAction", timeout=(self.timeout, LOCK_ACTION_TIMEOUT),
+                              nukiId=local_id, deviceType=device_type, action=action)
+        if not result.get("success"):
+            raise requests.RequestException(f"bridge {self.ip} failed to perform action {action}: {result}")
+
+    def reduct(self, x):
+        return x.replace(self.token, "<TOKEN>")
+
+    def close(self):
+        self.session.close()
+
+
+def split_smartlock_id(nuki_id: str) -> Tuple[int, int]:
+    """Split a Web API smartlock id into the (deviceType, nukiId) the bridge API uses - it is hex(deviceType) + hex(nukiId)."""
+    smartlock_id = int(nuki_id)
+    return smartlock_id >> 32, smartlock_id & 0xFFFFFFFF
+
+
+class NukiCallbackReceiver:
+    """Small HTTP server receiving the JSON lock state changes Nuki bridges POST to their registered callbacks."""
+
+    PATH = "/nuki"
+    MAX_BODY = 4096  # Callbacks are a few hundred bytes
+
+    def __init__(self, port: int, on_event: Callable[[str, Dict[str, Any]], None]):
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                except ValueError:
+                    length = -1
+                if self.path != receiver.PATH or not 0 <= length <= receiver.MAX_BODY:
+                    self.close_connection = True  # The body is left unread
+                    return self._reply(404 if self.path != receiver.PATH else 400)
+                body = self.rfile.read(length)
+                try:
+                    event = json.loads(body)
+                except ValueError:
+                    logger.warning("Unparsable Nuki callback from %s: %r", self.client_address[0], body)
+                    return self._reply(400)
+                receiver.received += 1
+                try:
+                    on_event(self.client_address[0], event)
+                except Exception as e:
+                    logger.exception("Error handling Nuki callback %s: %s", event, e)
+                self._reply(200)  # After dispatching, so the bridge sees the event was handled
+
+            def _reply(self, status: int):
+                self.send_response(status)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug("Nuki callback %s: " + format, self.client_address[0], *args)
+
+        self.port = port
+        self.received = 0
+        self.server = ThreadingHTTPServer(("", port), Handler)
+        self.server.daemon_threads = True
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
 class NukiAutoLock(Connector):
     def __init__(self, nuki: 'Nuki', nuki_id: str):
         super().__init__()  # Initialize with no value
@@ -19,22 +253,14 @@ class NukiAutoLock(Connector):
     
     def _set_action(self, value: bool) -> None:
         """Set the auto-lock state on Nuki"""
-        CNUKI = lambda cmd="": f'curl -sS "https://api.nuki.io/smartlock/{self.nuki_id}{cmd}" -H "Authorization: Bearer {self.nuki.api_key}" -H "Content-Type: application/json"'
-        
-        # Construct the command based on whether we're enabling or disabling
-        if value:
-            #Enable autolock, and lock door (if unlocked)
-            logger.info("Enable Autolock")
-            #cmd = f'output=$({CNUKI()}) && [[ "$output" =~ "\\"advancedConfig\\":(\\{{[^}}]*\\"autoLock\\":([^,]*)[^}}]*\\}})" ]] && adv_conf="${{${{match[1]/$match[2]/true}}/,\\"operationId\\":[^\}},]/}}" && {CNUKI("/advanced/config")} -X POST -d "$adv_conf" && [[ "$output" =~ "\\"state\\":\\{{[^}}]*\\"state\\":([^1])" ]] && {CNUKI("/action")} -X POST -d "{{action: 2}}"'
-            cmd = f'output=$({CNUKI()}) && {CNUKI("/advanced/config")} -X POST -d "$(jq -c \'.advancedConfig | .autoLock=true | del(.operationId)\' <<< $output)" && [[ $(jq -c .state.state <<< $output) != 1 ]] && {CNUKI("/action")} -X POST -d "{{action: 2}}"'            
-        else:
-            #Disable autolock, and Unlock door (if locked)
-            logger.info("Disable Autolock")
-            #cmd = f'output=$({CNUKI()}) && [[ "$output" =~ "\\"advancedConfig\\":(\\{{[^}}]*\\"autoLock\\":([^,]*)[^}}]*\\}})" ]] && adv_conf="${{${{match[1]/$match[2]/false}}/,\\"operationId\\":[^\}},]/}}" && {CNUKI("/advanced/config")} -X POST -d "$adv_conf" && [[ "$output" =~ "\\"state\\":\\{{[^}}]*\\"state\\":(1)" ]] && {CNUKI("/action")} -X POST -d "{{action: 1}}"'
-            cmd = f'output=$({CNUKI()}) && {CNUKI("/advanced/config")} -X POST -d "$(jq -c \'.advancedConfig | .autoLock=false | del(.operationId)\' <<< $output)" && [[ $(jq -c .state.state <<< $output) == 1 ]] && {CNUKI("/action")} -X POST -d "{{action: 1}}"'
+        # Enabling autolock also locks the door (if unlocked), disabling it unlocks the door (if locked)
+        logger.info("%s Autolock", "Enable" if value else "Disable")
+        self.nuki.client.submit((self.nuki_id, "autolock"), lambda: self._set_autolock(bool(value)))
 
-        logger.debug("Running Command: %s", self.nuki.reduct(cmd))
-        result = subprocess.run(cmd, shell=True, executable='/bin/zsh', capture_output=True, text=True)
+    def _set_autolock(self, enabled: bool):
+        action = self.nuki.client.set_autolock(self.nuki_id, enabled)
+        if action is not None:
+            self.nuki.lock_action(self.nuki_id, action)
 
 class NukiDevice(Connector):
     def __init__(self, nuki: 'Nuki', nuki_id: str):
@@ -42,49 +268,112 @@ class NukiDevice(Connector):
         self.nuki = nuki
         self.nuki_id = nuki_id
         self.name = f"NukiDevice<{nuki_id}>"
+        self.last_path: Optional[str] = None  # "bridge <ip>" or "cloud"
+        self.last_latency: Optional[float] = None
+
+        # Register for state changes reported by the bridge
+        self.nuki.register_device(self)
+
+    def _on_state(self, state: int):
+        """Handle a lock state reported by the bridge"""
+        if state == LOCKED:
+            self.set(False, act=False)
+        elif state in (UNLOCKED, UNLATCHED):
+            self.set(True, act=False)
+        # Transitional states (unlocking, locking, ...) are followed by a final one
     
     def _set_action(self, value: bool) -> None:
         """Set the lock state on Nuki - True for unlock, False for lock"""
-        CNUKI = lambda cmd="": f'curl -sS "https://api.nuki.io/smartlock/{self.nuki_id}{cmd}" -H "Authorization: Bearer {self.nuki.api_key}" -H "Content-Type: application/json"'
-        
-        # 1 - unlock, 2 - lock
-        # Construct the command based on whether we're locking or unlocking
         logger.info("%s the door (%s)", 'Unlocking' if value else 'Locking', self.nuki_id)
-        cmd = f'{CNUKI("/action")} -X POST -d "{{action: {1 if value else 2}}}"'
-        
-        logger.debug("Running Command: %s", self.nuki.reduct(cmd))
-        result = subprocess.run(cmd, shell=True, executable='/bin/zsh', capture_output=True, text=True)
+        action = UNLOCK if value else LOCK
+        self.nuki.client.submit((self.nuki_id, "action"), lambda: self._lock_action(action))
+
+    def _lock_action(self, action: int):
+        self.last_path, self.last_latency = self.nuki.lock_action(self.nuki_id, action)
 
     def autolock(self) -> 'NukiAutoLock':
         """Get a NukiAutoLock instance for this device"""
         return NukiAutoLock(self.nuki, self.nuki_id)
 
 class NukiBridge(Connector):
-    def __init__(self, nuki: 'Nuki', ip: str):
+    """
+    Notifies when the button of the bridge is pressed.
+
+    The bridge holds an /auth request open for 30 seconds, answering it with success as soon as its
+    button is pressed - so a single outstanding request is enough to catch presses as they happen.
+    """
+
+    def __init__(self, nuki: 'Nuki', ip: str, port: int = 8080):
         super().__init__()  # Initialize with no value
         self._value = True
         self.nuki = nuki
         self.ip = ip
+        self.port = port
         self.name = f"NukiBridge<{ip}>"
-        self.listener = ShellListener(f"(while true; do curl -sS 'http://{ip}:8080/auth' && echo '' || (echo 'nuki bridge error' >& 2; sleep 5;); sleep 1; done)")
+        self.running = True
 
-        self.buttonListener = self.listener.filter("(true)")
-        self.buttonListener.register(self.on_press)
+        logger.info("Starting Nuki Bridge listener for %s:%d", self.ip, self.port)
+        self.thread = threading.Thread(target=self._auth_loop)
+        self.thread.daemon = True
+        self.thread.start()
 
-        logger.info("Starting Nuki Bridge listener for %s:8080", self.ip)
-        self.listener.start()
-        
-    
-    def on_press(self, line, match):
+    def _auth_loop(self):
+        session = requests.Session()
+        while self.running:
+            try:
+                result = session.get(f"http://{self.ip}:{self.port}/auth", timeout=40).json()
+            except (requests.RequestException, ValueError) as e:
+                logger.error("nuki bridge error: %s", e)
+                time.sleep(5)
+                continue
+            if result.get("success"):
+                self.on_press()
+            time.sleep(1)
+
+    def on_press(self):
         self.notify_set()
         # threading.Timer(5, lambda: self.set(False)).start()
+
+    def stop(self):
+        self.running = False
         
         
 class Nuki(Service):
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, bridge_tokens: Optional[Dict[str, str]] = None, cache_ttl: float = 10,
+                 max_concurrency: int = 2, timeout: float = 10, retries: int = 2, bridge_timeout: float = 3,
+                 callback_port: int = 8090, callback_host: Optional[str] = None, poll_interval: float = 30):
+        """
+        Initialize the Nuki service.
+
+        Args:
+            api_key: Nuki Web API token
+            bridge_tokens: Bridge ip -> API token of the bridge. Lock actions for locks paired with one of
+                these bridges go through the bridge, falling back to the cloud when it is unreachable
+            cache_ttl: Seconds a fetched smartlock state / config is reused
+            max_concurrency: Maximum number of Web API requests in flight
+            timeout: Seconds to wait for an HTTP response
+            retries: Times to retry a request that failed to connect or timed out
+            bridge_timeout: Seconds to wait for a connection to a bridge before falling back to the cloud
+            callback_port: Port of the HTTP receiver the bridges push lock state changes to
+            callback_host: Address the bridges reach this host at (default: the local address on the route to each bridge)
+            poll_interval: Seconds between polls of a bridge whose callback could not be registered,
+                and between attempts to register it
+        """
         super().__init__()
         self.api_key = api_key
         self.bridges = {}
+        self.client = NukiWebClient(api_key, cache_ttl, max_concurrency, timeout, retries)
+
+        self.bridge_clients = {ip: NukiBridgeClient(ip, token, timeout=bridge_timeout) for ip, token in (bridge_tokens or {}).items()}
+        self._lock_bridges: Dict[Tuple[int, int], NukiBridgeClient] = {}  # (deviceType, nukiId) -> bridge it is paired with
+        self.latency: Dict[str, Tuple[int, float]] = {}  # path -> (commands, total seconds)
+
+        self._devices: Dict[Tuple[int, int], List[NukiDevice]] = {}  # (deviceType, nukiId) -> devices interested in its state
+        self.callback_port = callback_port
+        self.callback_host = callback_host
+        self.poll_interval = poll_interval
+        self.receiver: Optional[NukiCallbackReceiver] = None
+        self._stopped = threading.Event()
     
     def CMD(self,cmd=""):
         return 
@@ -92,10 +381,122 @@ class Nuki(Service):
     def device(self, nuki_id: str) -> NukiDevice:
         return NukiDevice(self,nuki_id)
 
+    def register_device(self, device: NukiDevice):
+        try:
+            key = split_smartlock_id(device.nuki_id)
+        except ValueError:
+            logger.warning("%s is not a numeric Web API id - its state will not be tracked", device.name)
+            return
+        self._devices.setdefault(key, []).append(device)
+
     def bridge(self,bridge_ip):
         if bridge_ip not in self.bridges:
             self.bridges[bridge_ip] = NukiBridge(self, bridge_ip)
         return self.bridges[bridge_ip]
 
-    def reduct(self,x):
-        return x.replace(self.api_key,"<API_KEY>")
+    def start(self):
+        if not self.bridge_clients:
+            return
+        try:
+            self.receiver = NukiCallbackReceiver(self.callback_port, self._on_callback)
+            self.receiver.start()
+        except OSError as e:
+            logger.error("Failed to start the Nuki callback receiver on port %d - polling bridges instead: %s", self.callback_port, e)
+        thread = threading.Thread(target=self._maintain_bridges)
+        thread.daemon = True
+        thread.start()
+
+    def _maintain_bridges(self):
+        """
+        Learn which bridge each lock is paired with (seeding the lock states), and register our callback
+        with every bridge. Bridges that can't be registered are polled every poll_interval until they can.
+        """
+        while True:
+            for bridge in self.bridge_clients.values():
+                if bridge.callback_registered:
+                    continue
+                try:
+                    locks = bridge.list()
+                except (requests.RequestException, ValueError) as e:
+                    logger.warning("Failed to list the locks of Nuki bridge %s: %s", bridge.ip, bridge.reduct(str(e)))
+                    continue
+                for lock in locks:
+                    key = (lock.get("deviceType", 0), lock["nukiId"])
+                    if key not in self._lock_bridges:
+                        logger.info("Nuki lock %s (%s) is paired with bridge %s", lock.get("name"), lock["nukiId"], bridge.ip)
+                    self._lock_bridges[key] = bridge
+                    self._on_state(key, lock.get("lastKnownState", {}))
+                if self.receiver:
+                    self._register_callback(bridge)
+
+            if all(bridge.callback_registered for bridge in self.bridge_clients.values()):
+                return
+            if self._stopped.wait(self.poll_interval):
+                return
+
+    def _register_callback(self, bridge: NukiBridgeClient):
+        url = f"http://{self.callback_host or bridge.local_address()}:{self.callback_port}{NukiCallbackReceiver.PATH}"
+        try:
+            bridge.register_callback(url)
+        except (requests.RequestException, ValueError, OSError) as e:
+            bridge.callback_failures += 1
+            (logger.warning if bridge.callback_failures == 1 else logger.debug)(
+                "Failed to register callback %s with Nuki bridge %s - polling it every %gs: %s",
+                url, bridge.ip, self.poll_interval, bridge.reduct(str(e)))
+            return
+        bridge.callback_registered = True
+        logger.info("Nuki bridge %s pushes lock states to %s", bridge.ip, url)
+
+    def _on_callback(self, source: str, event: Dict[str, Any]):
+        if source not in self.bridge_clients:
+            # The receiver has no auth of its own - only the bridges we registered with may drive the bindings
+            logger.warning("Ignoring Nuki callback from unknown host %s", source)
+            return
+        self._on_state((event.get("deviceType", 0), event["nukiId"]), event)
+
+    def _on_state(self, key: Tuple[int, int], state: Dict[str, Any]):
+        if "state" not in state:
+            return
+        self.client.record_state(*key, state["state"])
+        for device in self._devices.get(key, ()):
+            device._on_state(state["state"])
+
+    def lock_action(self, nuki_id: str, action: int) -> Tuple[str, float]:
+        """
+        Send a lock action, through the lock's bridge if it has one and otherwise (or if the bridge
+        fails) through the cloud. Returns the path used and its latency.
+        """
+        bridge = self._lock_bridges.get(split_smartlock_id(nuki_id))
+        if bridge:
+            start = time.monotonic()
+            try:
+                bridge.lock_action(nuki_id, action)
+                self.client.record_action(nuki_id, action)
+                return self._record_latency(f"bridge {bridge.ip}", nuki_id, start)
+            except requests.ReadTimeout:
+                # The bridge got the action and may still perform it - sending it through the cloud too could run it twice
+                logger.error("Nuki bridge %s did not confirm action %d for %s within %ds", bridge.ip, action, nuki_id, LOCK_ACTION_TIMEOUT)
+                raise
+            except (requests.RequestException, ValueError) as e:
+                logger.warning("Nuki bridge %s failed (%s) - falling back to the cloud", bridge.ip, bridge.reduct(str(e)))
+
+        start = time.monotonic()
+        self.client.lock_action(nuki_id, action)
+        return self._record_latency("cloud", nuki_id, start)
+
+    def _record_latency(self, path: str, nuki_id: str, start: float) -> Tuple[str, float]:
+        latency = time.monotonic() - start
+        count, total = self.latency.get(path, (0, 0.0))
+        self.latency[path] = (count + 1, total + latency)
+        logger.info("Lock action for %s sent through %s in %.0fms", nuki_id, path, latency * 1000)
+        return path, latency
+
+    def stop(self):
+        self._stopped.set()
+        if self.receiver:
+            self.receiver.stop()
+        for bridge in self.bridges.values():
+            bridge.stop()
+        self.client.close()
+        for bridge in self.bridge_clients.values():
+            bridge.close()
@@ -0,0 +1,185 @@
+#!/usr/bin/python3
+
+from .connector import Connector
+from .service import Service
+from logger import get_logger
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import hmac
+import json
+import re
+import threading
+from typing import Any, Dict, Optional
+
+# Get logger for this module
+logger = get_logger(__name__)
+
+PREFIX = "/hooks/"
+
+
+class WebhookConnector(Connector):
+    """
+    A connector other systems push values to over HTTP.
+
+    POST /hooks/<name> sets the value (the JSON request body, the plain text body if it isn't JSON,
+    or True when the body is empty) and GET /hooks/<name> returns the current value as JSON.
+    """
+
+    def __init__(self, webhook: 'Webhook', hook_name: str):
+        super().__init__()
+        self.webhook = webhook
+        self.hook_name = hook_name
+        self.name = f"Webhook<{hook_name}>"
+
+    def push(self, value: Any) -> None:
+        """Set the value from an HTTP push - every push is an event, even when the value repeats.
+
+        Values set through bindings keep the usual same-value deduplication, otherwise a two-way binding
+        to a connector that processes same-value events would bounce the value back and forth forever.
+        """
+        if value != self.get():
+            self.set(value)
+        else:
+            self.notify_set()
+
+    def _set_action(self, value: Any) -> None:
+        """Nothing to send - the value set by the bindings is served to GET requests"""
+        pass
+
+
+class Webhook(Service):
+    def __init__(self, port: int = 8088, host: str = "", token: Optional[str] = None, max_body: int = 65536):
+        """
+        Initialize the inbound HTTP webhook server.
+
+        Args:
+            port: TCP port to listen on
+            host: Address to listen on (default: all interfaces)
+            token: If set, requests must carry "Authorization: Bearer <token>" or "?token=<token>"
+            max_body: Maximum size of a request body in bytes
+        """
+        super().__init__()
+        logger.info("Creating Webhook service (port %d)", port)
+        self.host = host
+        self.port = port
+        self.token = token
+        self.max_body = max_body
+        self.hooks: Dict[str, WebhookConnector] = {}
+        self.server: Optional[ThreadingHTTPServer] = None
+
+    def device(self, hook_name: str) -> WebhookConnector:
+        hook_name = str(hook_name)
+        if hook_name not in self.hooks:
+            self.hooks[hook_name] = WebhookConnector(self, hook_name)
+        return self.hooks[hook_name]
+
+    def start(self):
+        webhook = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # Keep-alive
+            disable_nagle_algorithm = True  # Headers and body are written separately - don't hold the body for an ACK
+
+            def do_GET(self):
+                hook = self._hook()
+                if hook:
+                    self._reply(200, {"value": hook.get()})
+
+            def do_POST(self):
+                # Authorize and validate before reading anything, and close the connection whenever the
+                # body is left unread (it can't be skipped safely)
+                hook = self._hook()
+                if not hook:
+                    self.close_connection = True
+                    return
+                if "Transfer-Encoding" in self.headers:
+                    # Chunked bodies aren't supported - unread, the chunks would be parsed as the next request
+                    self.close_connection = True
+                    return self._reply(411, {"error": "Content-Length required"})
+                if "Content-Length" not in self.headers:
+                    self.close_connection = True  # Anything sent after the headers is not a request
+                    if self._body_waiting():
+                        return self._reply(411, {"error": "Content-Length required"})
+                try:
+                    length = int(self.headers.get("Content-Length") or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    self.close_connection = True
+                    return self._reply(400, {"error": "invalid Content-Length"})
+                if length > webhook.max_body:
+                    self.close_connection = True
+                    return self._reply(413, {"error": "body too large"})
+                value = webhook.parse_value(self.rfile.read(length))
+                logger.debug("Webhook %s set to %r by %s", hook.hook_name, value, self.client_address[0])
+                hook.push(value)
+                self._reply(200, {"value": hook.get()})
+
+            def _hook(self) -> Optional[WebhookConnector]:
+                url = urlsplit(self.path)
+                if not webhook.authorized(self.headers.get("Authorization"), parse_qs(url.query).get("token", [None])[0]):
+                    self._reply(401, {"error": "unauthorized"})
+                    return None
+                hook = webhook.hooks.get(url.path[len(PREFIX):]) if url.path.startswith(PREFIX) else None
+                if hook is None:
+                    self._reply(404, {"error": "no such hook"})
+                return hook
+
+            def _body_waiting(self) -> bool:
+                """Whether bytes follow the headers of a request without a Content-Length (checked without blocking)"""
+                timeout = self.connection.gettimeout()
+                self.connection.settimeout(0)
+                try:
+                    return bool(self.rfile.peek(1))
+                except OSError:
+                    return False
+                finally:
+                    self.connection.settimeout(timeout)
+
+            def _reply(self, status: int, body: Dict[str, Any]):
+                data = json.dumps(body, default=str).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                logger.debug("Webhook %s: %s", self.client_address[0], webhook.reduct(format % args))
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        logger.info("Starting Webhook server on port %d with hooks %s", self.port, sorted(self.hooks))
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """Stop the server."""
+        if self.server:
+            logger.info("Stopping Webhook server")
+            self.server.shutdown()
+            self.server.server_close()
+
+    def authorized(self, authorization: Optional[str], query_token: Optional[str]) -> bool:
+        if not self.token:
+            return True
+        supplied = query_token
+        if authorization and authorization.startswith("Bearer "):
+            supplied = authorization[len("Bearer "):]
+        return supplied is not None and hmac.compare_digest(supplied.encode(), self.token.encode())
+
+    @staticmethod
+    def reduct(x: str) -> str:
+        """Hide the token query parameter (a right or nearly right secret) from a request line."""
+        return re.sub(r"([?&]token=)[^&\s]*", r"\1<TOKEN>", x)
+
+    @staticmethod
+    def parse_value(body: bytes) -> Any:
+        text = body.decode("utf-8", errors="replace").strip()
+        if not text:
+            return True
+        try:
+            return json.loads(text)
+        except ValueError:
+            return text
@@ -2,26 +2,117 @@
 
 import subprocess
 import threading
+import selectors
+import heapq
 import time
+import os
 import re
-from typing import Callable, Any
+from typing import Callable, Any, Optional
 from traceback import format_exc
 from logger import get_logger
 
 logger = get_logger(__name__)
 
 
+def _required_literal(pattern: Optional[re.Pattern]) -> Optional[str]:
+    """The longest run of literal text every match of the pattern must contain, or None if we can't tell."""
+    if pattern is None or pattern.flags & (re.IGNORECASE | re.VERBOSE):
+        return None
+    source = pattern.pattern
+    runs, current, depth, in_class, i = [], "", 0, False, 0
+    while i < len(source):
+        char = source[i]
+        if char == "\\":
+            escaped = source[i + 1:i + 2]
+            if escaped and not escaped.isalnum() and depth == 0 and not in_class:
+                current += escaped
+            else:
+                runs.append(current)
+                current = ""
+            i += 2
+            continue
+        if in_class:
+            in_class = char != "]"
+        elif char == "|" and depth == 0:
+            return None  # Top-level alternation - no single required literal
+        elif char in "*?{":
+            runs.append(current[:-1])  # The previous character is optional (or repeated)
+            current = ""
+            if char == "{":  # Skip the repeat count
+                end = source.find("}", i)
+                i = end if end >= 0 else len(source)
+        elif char == "[":
+            runs.append(current)
+            current = ""
+            in_class = True
+            # A "]" right after "[" or "[^" is a member of the class, not its end
+            i += 2 if source[i + 1:i + 2] == "^" else 1
+            if source[i:i + 1] == "]":
+                i += 1
+            continue
+        elif char in ".^$+|()":
+            runs.append(current)
+            current = ""
+            depth += {"(": 1, ")": -1}.get(char, 0)
+        elif depth == 0:
+            current += char
+        i += 1
+    runs.append(current)
+    return max(runs, key=len) or None
+
+
 class FilterAnalyzer:
     def __init__(self, parent_analyzer=None, pattern=None, log = True):
         if pattern: logger.debug(f"Creating Shell Filter: {pattern}")
         self.parent = parent_analyzer
         self.pattern = re.compile(pattern) if pattern else None
+        self.literal = _required_literal(self.pattern)
         self.callbacks = []
         self.log = log
+
+        # Child filters, and the dispatcher compiled from them (rebuilt lazily when a filter is added)
+        self.children = []
+        self._compiled = False
         
         # Register with parent to receive all lines
         if self.parent:
-            self.parent.register(lambda line,matched_group: self._process_line(line))
+            self.parent._add_child(self)
+
+    def _add_child(self, child):
+        self.children.append(child)
+        self._compiled = False
+
+    def _compile(self):
+        """
+        Index children by the literal text their pattern requires, so a line only reaches the
+        children whose literal it contains. One lookahead alternation finds all literals in a line;
+        a literal found at some position implies that every literal that is a prefix of it is there too.
+        """
+        by_literal = {}
+        for order, child in enumerate(self.children):
+            child._order = order
+            if child.literal:
+                by_literal.setdefault(child.literal, []).append(child)
+        literals = sorted(by_literal, key=len, reverse=True)
+
+        self._unindexed = [child for child in self.children if not child.literal]
+        self._literal_scan = re.compile("(?=(%s))" % "|".join(map(re.escape, literals))) if literals else None
+        self._children_by_literal = {literal: [child for other in literals if literal.startswith(other) for child in by_literal[other]]
+                                     for literal in literals}
+        self._compiled = True
+
+    def _matching_children(self, line):
+        if not self._compiled:
+            self._compile()
+        if self._literal_scan is None:
+            return self._unindexed
+        candidates = set()
+        for found in self._literal_scan.finditer(line):
+            candidates.update(self._children_by_literal[found.group(1)])
+        if not candidates:
+            return self._unindexed
+        candidates.update(self._unindexed)
+        return sorted(candidates, key=lambda child: child._order)
     
     def _process_line(self, line):
         if self.pattern:
@@ -31,7 +122,14 @@ class FilterAnalyzer:
         else:
             matched_group = line
 
-        analyzed = any([self.safe_callback(callback, line, matched_group) is not None for callback in self.callbacks])
+        analyzed = False
+        for callback in self.callbacks:
+            if self.safe_callback(callback, line, matched_group) is not None:
+                analyzed = True
+        if self.children:
+            for child in self._matching_children(line):
+                if child._process_line(line) is not None:
+                    analyzed = True
         return analyzed if self.log else None 
     
     def safe_callback(self, callback, line, matched_group):
@@ -52,6 +150,91 @@ class FilterAnalyzer:
         return FilterAnalyzer(self, pattern, log) 
 
 
+class ShellMultiplexer:
+    """
+    A single I/O thread that reads the stdout/stderr pipes of every running ShellListener.
+
+    Pipes are read in binary mode with large reads and framed into lines here, so the number of
+    threads doesn't grow with the number of listeners and no pipe is ever left undrained.
+    Other threads hand work to the loop with call_soon / call_later.
+    """
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls) -> 'ShellMultiplexer':
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self._wakeup_read, self._wakeup_write = os.pipe()
+        os.set_blocking(self._wakeup_read, False)
+        os.set_blocking(self._wakeup_write, False)
+        self.selector.register(self._wakeup_read, selectors.EVENT_READ, None)
+
+        self._lock = threading.Lock()
+        self._timers = []  # heap of (when, sequence, callback)
+        self._sequence = 0
+
+        self.thread = threading.Thread(target=self._loop, name="ShellMultiplexer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def call_soon(self, callback: Callable[[], Any]):
+        self.call_later(0, callback)
+
+    def call_later(self, delay: float, callback: Callable[[], Any]):
+        with self._lock:
+            self._sequence += 1
+            heapq.heappush(self._timers, (time.monotonic() + delay, self._sequence, callback))
+        try:
+            os.write(self._wakeup_write, b"x")
+        except BlockingIOError:
+            pass  # Already woken up
+
+    def register(self, fd: int, callback: Callable[[int], Any]):
+        """Call callback(fd) from the loop whenever fd is readable - only call from the loop thread."""
+        os.set_blocking(fd, False)
+        self.selector.register(fd, selectors.EVENT_READ, callback)
+
+    def unregister(self, fd: int):
+        self.selector.unregister(fd)
+
+    def _run_due_timers(self) -> Optional[float]:
+        """Run the callbacks that are due, and return the time until the next one."""
+        while True:
+            with self._lock:
+                if not self._timers:
+                    return None
+                when, _, callback = self._timers[0]
+                delay = when - time.monotonic()
+                if delay > 0:
+                    return delay
+                heapq.heappop(self._timers)
+            try:
+                callback()
+            except Exception:
+                logger.error(f"Error in shell multiplexer callback:\n{format_exc()}")
+
+    def _loop(self):
+        while True:
+            timeout = self._run_due_timers()
+            for key, _ in self.selector.select(timeout):
+                if key.data is None:
+                    try:
+                        os.read(self._wakeup_read, 4096)
+                    except BlockingIOError:
+                        pass
+                    continue
+                try:
+                    key.data(key.fd)
+                except Exception:
+                    logger.error(f"Error reading shell listener output:\n{format_exc()}")
+
+
 class ShellListener(FilterAnalyzer):
     def __init__(self, shell_command=None, executable=None):
         """
@@ -66,6 +249,9 @@ class ShellListener(FilterAnalyzer):
         self.executable = executable
         self.running = False
         self.process = None
+        self._streams = {}  # fd -> pipe
+        self._partial = {}  # fd -> incomplete line bytes
+        self._open_streams = 0
         # self.start()
         
     def start(self):
@@ -74,9 +260,7 @@ class ShellListener(FilterAnalyzer):
             return
             
         self.running = True
-        self.thread = threading.Thread(target=self._listen_loop)
-        self.thread.daemon = True
-        self.thread.start()
+        ShellMultiplexer.instance().call_soon(self._spawn)
 
     def stop(self):
         """Stop the listener."""
@@ -88,50 +272,66 @@ class ShellListener(FilterAnalyzer):
             except:
                 pass
 
-    def _listen_loop(self):
-        """Main listening loop that executes the shell command and processes output."""
-        while self.running:
-            try:
-                logger.debug(f"Starting Shell Listener")
-                #logger.debug(f"Starting Shell Listener {self.shell_command}")
-                self.process = subprocess.Popen(
-                    self.shell_command,
-                    shell=True,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True,
-                    bufsize=1, 
-                    executable=self.executable
-                )
-                while self.running:
-                    line = self.process.stdout.readline().strip()
-                    if not line and self.process.poll() is not None:
-                        break
-                    if line:
-                        #logger.debug("Processing Line: %s", line)
-                        if self._process_line(line):
-                            logger.debug("Shell line: %s", line)
-
-                logger.warning("Listener ended")
-                out, err = self.process.communicate()
-                if err: 
-                    logger.error(f"{err}")    
-            except Exception as e:
-                logger.error("Listener error: %s", e)
-            finally:
-                logger.warning("Restarting listener")
-                time.sleep(5)
-        logger.info("Listen loop ended")
-
-
-
-
-
-
-
-
-
+    def _spawn(self):
+        """Start the shell command and hand its pipes to the multiplexer (runs on the multiplexer thread)."""
+        if not self.running:
+            return
+        multiplexer = ShellMultiplexer.instance()
+        try:
+            logger.debug(f"Starting Shell Listener")
+            #logger.debug(f"Starting Shell Listener {self.shell_command}")
+            self.process = subprocess.Popen(
+                self.shell_command,
+                shell=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                bufsize=0,
+                executable=self.executable
+            )
+            self._stdout = self.process.stdout.fileno()
+            self._open_streams = 2
+            for stream in (self.process.stdout, self.process.stderr):
+                self._streams[stream.fileno()] = stream
+                self._partial[stream.fileno()] = b""
+                multiplexer.register(stream.fileno(), self._on_readable)
+        except Exception as e:
+            logger.error("Listener error: %s", e)
+            logger.warning("Restarting listener")
+            multiplexer.call_later(5, self._spawn)
 
+    def _on_readable(self, fd: int):
+        data = os.read(fd, 65536)
+        if data:
+            *lines, self._partial[fd] = (self._partial[fd] + data).split(b"\n")
+        else:
+            # EOF - whatever is left is the last line
+            lines = [self._partial.pop(fd)]
+            ShellMultiplexer.instance().unregister(fd)
+            self._streams.pop(fd).close()
 
+        for line in lines:
+            line = line.decode("utf-8", errors="replace").strip()
+            if not line:
+                continue
+            if fd != self._stdout:
+                logger.error(f"{line}")
+            elif self._process_line(line):
+                logger.debug("Shell line: %s", line)
 
+        if not data:
+            self._open_streams -= 1
+            if self._open_streams == 0:
+                self._on_exit(self.process)
 
+    def _on_exit(self, process):
+        """Both pipes are closed - reap the process and restart it after a pause."""
+        if process and process.poll() is None:
+            # Closed its output but hasn't exited yet - check again shortly
+            ShellMultiplexer.instance().call_later(0.1, lambda: self._on_exit(process))
+            return
+        logger.warning("Listener ended")
+        if self.running:
+            logger.warning("Restarting listener")
+            ShellMultiplexer.instance().call_later(5, self._spawn)
+        else:
+            logger.info("Listen loop ended")